@@ -0,0 +1,430 @@
+# Shared HTTP client used by the scripts in this folder.
+# Keeps connections alive between calls, retries on 429/5xx with backoff (POST/PATCH only if the server rejected them)
+# and applies a timeout to every request.
+# Independent calls can be run concurrently with `map`, limited by the configured number of workers.
+# Every request is recorded in the metrics of the run (see run_metrics.py).
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from run_metrics import metrics as run_metrics
+
+DEFAULT_TIMEOUT = 30  # Seconds to wait for the server before giving up on a request
+DEFAULT_WORKERS = 8  # Number of requests that may run at the same time
+DEFAULT_RETRIES = 5  # Number of retries on connection errors, 429 and 5xx responses
+DEFAULT_BACKOFF = 0.5  # Backoff factor in seconds (0.5, 1, 2, 4, ... between retries)
+DEFAULT_BATCH_SIZE = 100  # Number of objects sent in one call to a batch endpoint
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+REJECTED_STATUS_CODES = (429, 503)  # The server refused the request without handling it
+
+
+# Retries idempotent methods (GET, PUT, DELETE, ...) on every status in the forcelist and on connection and read errors.
+# POST and PATCH may have been handled already when the server answers with 500/502/504 or the response times out,
+# sending them again could e.g. create a session twice. They are only retried when the server rejected them (429/503)
+# or the connection could not be established.
+class WriteSafeRetry(Retry):
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code in REJECTED_STATUS_CODES and status_code in (self.status_forcelist or ()):
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# Limits the number of calls in flight. The limit is halved whenever the server answers with 429/5xx
+# (or the call raises) and grows back by one after every `increase_after` successful calls.
+class AdaptiveLimiter:
+    def __init__(self, max_limit, min_limit=1, increase_after=10):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.increase_after = increase_after
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, ok):
+        with self.condition:
+            self.in_flight -= 1
+            if ok:
+                self.successes += 1
+                if self.successes >= self.increase_after and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            else:
+                if self.limit > self.min_limit:
+                    self.limit = max(self.min_limit, self.limit // 2)
+                    print(f"Server is returning errors, lowering concurrency to {self.limit}")
+                self.successes = 0
+            self.condition.notify_all()
+
+
+# Token bucket that allows `rate` calls per second on average and bursts of up to `burst` calls.
+# Shared between threads, every caller reserves a token and sleeps until it is due. A rate of None disables the limit.
+class TokenBucket:
+    def __init__(self, rate, burst=1, name="rate limit"):
+        self.rate = rate
+        self.name = name  # Waits for a token are recorded under this name in the metrics of the run
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+            run_metrics.record_wait(self.name, wait)
+
+
+# Number of times the client had to retry the request before it got this response
+def retry_count(response):
+    retries = getattr(response.raw, "retries", None)
+    return len(retries.history) if retries else 0
+
+
+# A response counts as an error if it failed, or only succeeded after the client had to retry it
+def is_server_error(response):
+    return response.status_code in RETRY_STATUS_CODES or retry_count(response) > 0
+
+
+# Bytes of the request body and the response body
+def body_sizes(response, stream=False):
+    body = response.request.body
+    sent = len(body) if isinstance(body, (bytes, str)) else 0
+    received = int(response.headers.get("Content-Length") or 0) if stream else len(response.content)
+    return sent, received
+
+
+# Splits items into lists of at most size elements. items may be a generator.
+def chunked(items, size):
+    items = iter(items)
+    while chunk := list(itertools.islice(items, size)):
+        yield chunk
+
+
+# Calls fn and returns the status code of its response, or the exception if the request failed
+def call_status(fn, arg):
+    try:
+        return fn(arg).status_code
+    except requests.RequestException as e:
+        return e
+
+
+# Groups writes into chunks that are sent to a batch endpoint of the server. Chunks are sent concurrently.
+# If there is no batch endpoint (send_batch is None) or the server does not know it (older versions answer 404),
+# the items are sent one by one with send_single instead, also concurrently.
+# verify_batch(response, chunk) can check a successful batch response. If it returns False, the server did not apply
+# every write of the chunk and its items are sent one by one, so every item gets its own status.
+class BatchWriter:
+    def __init__(self, client, send_batch, send_single, batch_size=DEFAULT_BATCH_SIZE, verify_batch=None):
+        self.client = client
+        self.send_batch = send_batch
+        self.send_single = send_single
+        self.verify_batch = verify_batch
+        self.batch_size = max(1, batch_size)
+        self.batch_supported = send_batch is not None
+
+    # Yields (item, result) for every item. result is the status code of the response or the raised exception.
+    def write(self, items):
+        items = iter(items)
+        if self.batch_supported:
+            for results in self.client.map(self.write_chunk, self.chunks(items)):
+                yield from results
+        # Without a batch endpoint every item is its own call, so all workers are used even for a few items
+        yield from self.client.map(self.write_single, items)
+
+    # Chunks of items, until the server turned out not to support the batch endpoint
+    def chunks(self, items):
+        while self.batch_supported and (chunk := list(itertools.islice(items, self.batch_size))):
+            yield chunk
+
+    def write_single(self, item):
+        return item, call_status(self.send_single, item)
+
+    def write_chunk(self, chunk):
+        if self.batch_supported:
+            try:
+                response = self.send_batch(chunk)
+            except requests.RequestException as e:
+                return [(item, e) for item in chunk]
+            if response.status_code == 200 and self.verify_batch is not None and not self.verify_batch(response, chunk):
+                print(f"The server did not apply every write of a batch, sending its {len(chunk)} writes one by one")
+                return [self.write_single(item) for item in chunk]
+            if response.status_code != 404:
+                return [(item, response.status_code) for item in chunk]
+            if self.batch_supported:
+                self.batch_supported = False
+                print("The server does not support the batch endpoint, falling back to single requests")
+        return [self.write_single(item) for item in chunk]
+
+
+# The batch update endpoint answers 200 even if it did not update every item, it reports the number of updated items
+def all_items_updated(response, updates):
+    try:
+        return response.json().get("updates") == len(updates)
+    except (ValueError, AttributeError):
+        return False
+
+
+# Returns the part of a media payload that differs from the fetched media of a library item, or None if nothing changes.
+# Nested objects like "metadata" are compared field by field, so only the changed fields are sent.
+def media_delta(media, payload):
+    delta = {}
+    for key, value in payload.items():
+        current = media.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            changed_fields = {field: field_value for field, field_value in value.items() if current.get(field) != field_value}
+            if changed_fields:
+                delta[key] = changed_fields
+        elif current != value:
+            delta[key] = value
+    return delta or None
+
+
+# Sends media updates through a media updater, but only what actually changes, and counts the outcome.
+# Updates that would not change anything are skipped without a request.
+class MediaDeltaWriter:
+    def __init__(self, media_updater):
+        self.media_updater = media_updater
+        self.changed = 0
+        self.skipped = 0
+        self.failed = 0
+
+    # updates are (library_item, media_payload) tuples. Yields (library_item, result) for every update, where result is
+    # the status code or exception of the write, or None if it was skipped. Skipped items may be yielded ahead of the others.
+    def write(self, updates):
+        items_by_id = {}
+        skipped = deque()
+
+        def deltas():
+            for item, payload in updates:
+                delta = media_delta(item['media'], payload)
+                if delta is None:
+                    skipped.append(item)
+                    continue
+                items_by_id[item['id']] = item
+                yield item['id'], delta
+
+        for (item_id, _), status in self.media_updater.write(deltas()):
+            while skipped:
+                yield self.count(skipped.popleft(), None)
+            yield self.count(items_by_id.pop(item_id), status)
+        while skipped:
+            yield self.count(skipped.popleft(), None)
+
+    def count(self, item, status):
+        if status is None:
+            self.skipped += 1
+        elif status == 200:
+            self.changed += 1
+        else:
+            self.failed += 1
+        return item, status
+
+    def summary(self):
+        return f"{self.changed} changed, {self.skipped} skipped without changes, {self.failed} failed"
+
+
+class HttpClient:
+    def __init__(self, host, headers=None, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT, limiter=None, metrics=run_metrics):
+        self.host = host.rstrip("/")
+        self.metrics = metrics
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.limiter = limiter  # Optional AdaptiveLimiter that every request has to pass
+
+        retry = WriteSafeRetry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS_CODES,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        # One pooled connection per worker, so concurrent calls never wait for a free socket
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/json"})
+        if headers:
+            self.session.headers.update(headers)
+
+    def url(self, path):
+        return f"{self.host}{path}"
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if self.limiter is not None:
+            with self.metrics.waiting("concurrency limit"):
+                self.limiter.acquire()
+
+        response = None
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+            return response
+        finally:
+            seconds = time.perf_counter() - started
+            if response is None:
+                self.metrics.record_request(method, path, None, seconds)
+            else:
+                self.metrics.record_request(method, path, response.status_code, seconds,
+                                            *body_sizes(response, kwargs.get("stream", False)), retry_count(response))
+            if self.limiter is not None:
+                self.limiter.release(response is not None and not is_server_error(response))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    # Same as `get`, but raises on error responses and returns the decoded JSON body
+    def get_json(self, path, **kwargs):
+        response = self.get(path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    # Yields the entries of a paginated endpoint page by page, so only two pages are held in memory at once.
+    # The next page is already requested while the caller is still working on the current one.
+    # With reverse=True the pages are walked from the last to the first one. Use this when the caller deletes
+    # entries while iterating, otherwise the deletions shift later entries onto pages that were already read.
+    def iter_pages(self, path, key, per_page, params=None, limit_param="itemsPerPage", reverse=False):
+        params = dict(params or {})
+
+        def fetch(page):
+            return self.get_json(path, params={**params, limit_param: per_page, "page": page})
+
+        first = fetch(0)
+        num_pages = first.get("numPages")
+        if num_pages is None and first.get("total") is not None:
+            num_pages = -(-first["total"] // per_page)
+
+        if num_pages is None:
+            # The endpoint is not paged (e.g. the authors of a library), the first response already holds everything
+            pages = iter(())
+        elif reverse:
+            pages = iter(range(num_pages - 1, 0, -1))
+        else:
+            pages = iter(range(1, num_pages))
+
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            def prefetch_next():
+                page = next(pages, None)
+                return None if page is None else prefetcher.submit(fetch, page)
+
+            future = prefetch_next()
+            if not reverse:
+                yield from first[key]
+            while future is not None:
+                results = future.result()[key]
+                future = prefetch_next()
+                yield from results
+            if reverse:
+                yield from first[key]
+
+    # Runs fn for every element of items on the worker pool. Results are yielded in input order.
+    # items may be a generator, it is only consumed a few elements ahead of the running calls.
+    def map(self, fn, items):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AbsClient(HttpClient):
+    def __init__(self, host, api_key, **kwargs):
+        super().__init__(host, headers={"Authorization": f"Bearer {api_key}"}, **kwargs)
+
+    def get_libraries(self):
+        return self.get_json("/api/libraries")["libraries"]
+
+    def get_users(self):
+        return self.get_json("/api/users")["users"]
+
+    def iter_library_items(self, library_id, per_page=500, params=None):
+        return self.iter_pages(f"/api/libraries/{library_id}/items", "results", per_page, params, limit_param="limit")
+
+    # The server returns all authors of a library at once. per_page is only sent along in case a server pages them.
+    def iter_library_authors(self, library_id, per_page=500):
+        return self.iter_pages(f"/api/libraries/{library_id}/authors", "authors", per_page, limit_param="limit")
+
+    def iter_listening_sessions(self, user_id, per_page=500, reverse=False):
+        return self.iter_pages(f"/api/users/{user_id}/listening-sessions", "sessions", per_page, reverse=reverse)
+
+    # Writer for session ids
+    def session_deleter(self, batch_size=DEFAULT_BATCH_SIZE):
+        return BatchWriter(
+            self,
+            lambda session_ids: self.post("/api/sessions/batch/delete", json={"sessions": session_ids}),
+            lambda session_id: self.delete(f"/api/sessions/{session_id}"),
+            batch_size,
+        )
+
+    # Writer for (library_item_id, media_payload) tuples, e.g. ("li_123", {"metadata": {"genres": [...]}})
+    def media_updater(self, batch_size=DEFAULT_BATCH_SIZE):
+        return BatchWriter(
+            self,
+            lambda updates: self.post("/api/items/batch/update", json=[{"id": item_id, "mediaPayload": payload} for item_id, payload in updates]),
+            lambda update: self.patch(f"/api/items/{update[0]}/media", json=update[1]),
+            batch_size,
+            verify_batch=all_items_updated,
+        )
+
+    # Writer for progress updates of the current user, each one a dict containing the libraryItemId
+    def progress_updater(self, batch_size=DEFAULT_BATCH_SIZE):
+        return BatchWriter(
+            self,
+            lambda updates: self.patch("/api/me/progress/batch/update", json=updates),
+            lambda update: self.patch(f"/api/me/progress/{update['libraryItemId']}", json=update),
+            batch_size,
+        )
+
+    # Writer for author ids. The server has no batch endpoint for authors, so they are deleted concurrently one by one.
+    # before_request is called right before every delete, e.g. to take a token of a rate limiter.
+    def author_deleter(self, batch_size=DEFAULT_BATCH_SIZE, before_request=None):
+        def delete_author(author_id):
+            if before_request is not None:
+                before_request()
+            return self.delete(f"/api/authors/{author_id}")
+
+        return BatchWriter(self, None, delete_author, batch_size)
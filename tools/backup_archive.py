@@ -0,0 +1,73 @@
+# Reads and rewrites Audiobookshelf backup files (.audiobookshelf, a zip file) without unpacking them.
+# Only the database is extracted. When the backup is packed again, all other files (covers, metadata, ...) are
+# copied unchanged from the old into the new backup, without decompressing and compressing them again.
+import copy
+import os
+import shutil
+import struct
+import zipfile
+
+DB_NAME = "absdatabase.sqlite"
+
+
+# Extracts the database of the backup into target_dir and returns its path, or None if the backup has no database
+def extract_database(backup_file, target_dir):
+    with zipfile.ZipFile(backup_file) as backup_zip:
+        if DB_NAME not in backup_zip.NameToInfo:
+            return None
+        return backup_zip.extract(DB_NAME, target_dir)
+
+
+# Removes the ZIP64 field from the extra data of a member. FileHeader adds a new one if the member needs it.
+def strip_zip64_extra(extra):
+    stripped = b""
+    while len(extra) >= 4:
+        header_id, size = struct.unpack("<HH", extra[:4])
+        if header_id != 0x0001:
+            stripped += extra[:4 + size]
+        extra = extra[4 + size:]
+    return stripped
+
+
+# Copies the still compressed data of a member from one zip file into another.
+# zipfile has no public API for this, so the local header is written here and the member is registered
+# in the target's file list, from which zipfile writes the central directory when the target is closed.
+def copy_member_raw(source_zip, target_zip, info):
+    source_zip.fp.seek(info.header_offset)
+    local_header = source_zip.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+    source_zip.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    member = copy.copy(info)
+    member.extra = strip_zip64_extra(info.extra)
+    member.flag_bits &= ~0x08  # CRC and sizes are known and written into the header, no data descriptor follows
+
+    target_zip.fp.seek(target_zip.start_dir)
+    member.header_offset = target_zip.fp.tell()
+    target_zip.fp.write(member.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source_zip.fp.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise EOFError(f"Unexpected end of backup while copying {info.filename}")
+        target_zip.fp.write(chunk)
+        remaining -= len(chunk)
+    target_zip.start_dir = target_zip.fp.tell()
+    target_zip.filelist.append(member)
+    target_zip.NameToInfo[member.filename] = member
+
+
+# Packs the changed database and all other files of the backup into a new backup.
+# The original backup is kept with the extension .bak and the new one is put in its place.
+def repack_backup(backup_file, db_path):
+    with zipfile.ZipFile(backup_file) as source_zip, zipfile.ZipFile(f"{backup_file}.tmp", "w", zipfile.ZIP_DEFLATED, allowZip64=True) as target_zip:
+        db_info = zipfile.ZipInfo(DB_NAME, date_time=source_zip.getinfo(DB_NAME).date_time)
+        db_info.compress_type = zipfile.ZIP_DEFLATED
+        with open(db_path, "rb") as db_file, target_zip.open(db_info, "w", force_zip64=True) as db_member:
+            shutil.copyfileobj(db_file, db_member, 1024 * 1024)
+        for info in source_zip.infolist():
+            if info.filename != DB_NAME:
+                copy_member_raw(source_zip, target_zip, info)
+
+    os.replace(backup_file, f"{backup_file}.bak")
+    os.replace(f"{backup_file}.tmp", backup_file)
@@ -1,56 +1,98 @@
 # MAKE A BACKUP BEFORE USE! DATA IS NOT RECOVERABLE IF THERE IS A PROBLEM WITH RETURNED DATA!
 # This script automatically deletes all listening sessions that are larger than a given threshold.
 # Depending on the size of the database, this script might take a while to run.
-import sys
-import time
-import requests
+from abs_client import AbsClient, AdaptiveLimiter
+from session_store import SessionStore
+from run_metrics import metrics, write_metrics_at_exit
 
 # Configuration constants
 ABS_HOST = ""  # AudiobookShelf Host URL
 USER_IDS = []  # The users that should be processed to delete. Keep empty to process all users.
 API_KEY = ""
 LISTENING_SESSION_THRESHOLD = 16  # Threshold in hours to delete listening sessions. Everything larger than this will be deleted.
-SESSIONS_TO_FETCH = 2000000  # Number of sessions to fetch per user. The script does not use pagination as it is a one-time script. Just set to a high number to fetch all sessions.
+SESSIONS_PER_PAGE = 500  # Number of sessions fetched per request. Memory usage only depends on this, not on the size of the history (except with USE_ANOMALY_SCANNER, which holds all sessions of a user).
+WORKERS = 8  # Number of delete requests running at the same time. Lowered automatically while the server returns errors.
+BATCH_SIZE = 100  # Number of sessions deleted per request. Older servers without the batch endpoint delete them one by one.
+SESSION_STORE_FILE = None  # Keep the sessions in this file (e.g. "sessions.sqlite"), so later runs only download new and changed ones. All users are synced before the first delete is sent.
+USE_ANOMALY_SCANNER = False  # Instead of the threshold, delete the duplicate sessions found by session_anomalies.py. Needs NumPy.
+METRICS_FILE = "cleanup_listening_sessions.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
 
 
 ######### Code #########
 
-if len(USER_IDS) == 0:
-    print(f"{ABS_HOST}/api/users?token={API_KEY}")
+if USE_ANOMALY_SCANNER:
+    from session_anomalies import scan
+
+write_metrics_at_exit(METRICS_FILE, "cleanup_listening_sessions")
+client = AbsClient(ABS_HOST, API_KEY, workers=WORKERS, limiter=AdaptiveLimiter(WORKERS))
 
-    # Use Bearer token to get user data
-    user_response = requests.get(f"{ABS_HOST}/api/users?token={API_KEY}")
-    print(user_response.reason)
-    for user in user_response.json()['users']:
+if len(USER_IDS) == 0:
+    for user in client.get_users():
         USER_IDS.append(user['id'])
 
 print(f"Processing {len(USER_IDS)} users")
 
-for user_id in USER_IDS:
-    sessions_response = requests.get(f"{ABS_HOST}/api/users/{user_id}/listening-sessions?itemsPerPage={SESSIONS_TO_FETCH}&token={API_KEY}")
-    sessions_to_delete = []
-    session_time_not_deleted = 0
-    session_time_deleted = 0
-    for session in sessions_response.json()['sessions']:
-        session_id = session['id']
-        if session['timeListening'] is None:
-            continue
-        session_duration = session['timeListening'] / 3600
-        if session_duration > LISTENING_SESSION_THRESHOLD:
-            session_time_deleted += session_duration
-            print("Session greater than threshold:", session_id, session_duration, "hours")
-            sessions_to_delete.append((session_id, session_duration))
-        else:
-            session_time_not_deleted += session_duration
-    print(f"User {user_id} has {len(sessions_to_delete)} sessions to delete with a total duration of {session_time_deleted} hours. ({session_time_not_deleted} hours not deleted)")
-
-    for session in sessions_to_delete:
-        session_id = session[0]
-        delete_response = requests.delete(f"{ABS_HOST}/api/sessions/{session_id}?token={API_KEY}")
-        if delete_response.status_code == 200:
-            print(f"Deleted session {session_id}")
+session_store = None
+if SESSION_STORE_FILE is not None:
+    session_store = SessionStore(SESSION_STORE_FILE)
+    with metrics.phase("sync sessions"):
+        session_store.sync(client, USER_IDS, SESSIONS_PER_PAGE)
+
+
+# Yields the ids of all sessions that should be deleted, user after user and page after page.
+# Deletions already run while the following pages and users are fetched.
+def sessions_to_delete():
+    for user_id in USER_IDS:
+        num_sessions_to_delete = 0
+        session_time_not_deleted = 0
+        session_time_deleted = 0
+        if session_store is not None:
+            sessions = session_store.sessions(user_id=user_id)
         else:
-            print(f"Error deleting session {session_id}: {delete_response.status_code}")
-    print("\n----------------------\n")
+            # Pages are read from the last one, so deleting sessions never moves unread sessions to an earlier page
+            sessions = client.iter_listening_sessions(user_id, SESSIONS_PER_PAGE, reverse=True)
+        flagged_ids = None
+        if USE_ANOMALY_SCANNER:
+            sessions = [session for session in sessions if session['timeListening'] is not None]
+            flagged_ids = {candidate['id'] for candidate in scan(sessions) if candidate['action'] == "delete"}
+        for session in sessions:
+            session_id = session['id']
+            if session['timeListening'] is None:
+                continue
+            session_duration = session['timeListening'] / 3600
+            if flagged_ids is not None and session_id in flagged_ids:
+                session_time_deleted += session_duration
+                num_sessions_to_delete += 1
+                print("Session flagged as duplicate:", session_id, session_duration, "hours")
+                yield session_id
+            elif flagged_ids is None and session_duration > LISTENING_SESSION_THRESHOLD:
+                session_time_deleted += session_duration
+                num_sessions_to_delete += 1
+                print("Session greater than threshold:", session_id, session_duration, "hours")
+                yield session_id
+            else:
+                session_time_not_deleted += session_duration
+        print(f"User {user_id} has {num_sessions_to_delete} sessions to delete with a total duration of {session_time_deleted} hours. ({session_time_not_deleted} hours not deleted)")
+        print("\n----------------------\n")
+
+
+deleted = []
+failed = 0
+for session_id, status in client.session_deleter(BATCH_SIZE).write(sessions_to_delete()):
+    if status == 200:
+        deleted.append(session_id)
+        print(f"Deleted session {session_id}")
+    elif status == 404 and session_store is not None:
+        # The session store still had a session that was already deleted on the server
+        deleted.append(session_id)
+        print(f"Session {session_id} was already deleted on the server")
+    else:
+        failed += 1
+        print(f"Error deleting session {session_id}: {status}")
+
+if session_store is not None:
+    session_store.remove(deleted)
+    session_store.close()
 
-print("Done")
\ No newline at end of file
+print(f"Deleted {len(deleted)} sessions ({failed} failed)")
+print("Done")
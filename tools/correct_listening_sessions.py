@@ -1,28 +1,47 @@
 # This script can correct listening session that are to long/inaccurate.
-import os
+# In bulk mode, all sessions of the user are fetched once, every session matching BULK_RULE is listed and the selected
+# ones are corrected at once. Their listening time is set to the time between start and end position, or to the
+# suggestion of the anomaly scanner (USE_ANOMALY_SCANNER).
+import json
 import sys
 import time
-import requests
+
+from abs_client import AbsClient, AdaptiveLimiter, call_status
+from session_store import SessionStore
+from run_metrics import metrics, write_metrics_at_exit
 
 # Configuration constants
 ABS_HOST = ""  # AudiobookShelf Host URL
 USER_ID = ""  # The users that should be processed.
 API_KEY = ""
+BULK_MODE = False  # Correct many sessions at once. Can also be enabled with --bulk.
+BULK_RULE = lambda session: session['timeListening'] > 2 * abs(session['currentTime'] - session['startTime'])  # Sessions listed in bulk mode
+SESSIONS_PER_PAGE = 500  # Number of sessions fetched per request in bulk mode
+WORKERS = 8  # Number of sessions corrected at the same time in bulk mode. Lowered automatically while the server returns errors.
+BATCH_SIZE = 100  # Number of sessions deleted per request in bulk mode. Older servers without the batch endpoint delete them one by one.
+FAILED_SESSIONS_FILE = "failed_sessions.json"  # Sessions that were deleted but could not be created again are saved here
+USE_ANOMALY_SCANNER = False  # List the sessions flagged by session_anomalies.py with its suggested listening time instead of BULK_RULE. Needs NumPy.
+SESSION_STORE_FILE = "sessions.sqlite"  # Bulk mode keeps the sessions in this file, so later runs only download new and changed ones. Set to None to disable.
+METRICS_FILE = "correct_listening_sessions.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
 
 
 ######### Code #########
 
+if USE_ANOMALY_SCANNER:
+    from session_anomalies import scan
+
+write_metrics_at_exit(METRICS_FILE, "correct_listening_sessions")
+client = AbsClient(ABS_HOST, API_KEY, workers=WORKERS, limiter=AdaptiveLimiter(WORKERS))
+
 def seconds_to_time_string(seconds):
     return time.strftime('%H:%M:%S', time.gmtime(seconds))
 
 
 def fetch_sessions(page):
-    response = requests.get(
-        f"{ABS_HOST}/api/users/{USER_ID}/listening-sessions",
-        params={"itemsPerPage": 10, "page": page, "token": API_KEY}
+    return client.get_json(
+        f"/api/users/{USER_ID}/listening-sessions",
+        params={"itemsPerPage": 10, "page": page}
     )
-    response.raise_for_status()
-    return response.json()
 
 
 def display_sessions(sessions):
@@ -75,17 +94,10 @@ def adjust_session(session):
 
 def update_session(session):
     session_id = session['id']
-    delete_response = requests.delete(
-        f"{ABS_HOST}/api/sessions/{session_id}",
-        params={"token": API_KEY}
-    )
+    delete_response = client.delete(f"/api/sessions/{session_id}")
     if delete_response.status_code == 200:
         print(f"Session {session_id} deleted.")
-        create_response = requests.post(
-            f"{ABS_HOST}/api/session/local",
-            params={"token": API_KEY},
-            json=session
-        )
+        create_response = client.post("/api/session/local", json=session)
         if create_response.status_code == 200:
             print(f"Session {session_id} updated.")
         else:
@@ -94,6 +106,104 @@ def update_session(session):
         print(f"Error deleting session {session_id}: {delete_response.status_code}")
 
 
+# Parses a selection like "all", "3", "1-20" or "1-5, 8, 10-12" into 0-based indexes
+def parse_selection(selection, count):
+    if selection.strip().lower() == "all":
+        return list(range(count))
+    indexes = []
+    for part in selection.split(","):
+        start, _, end = part.strip().partition("-")
+        start = int(start)
+        end = int(end) if end else start
+        if start < 1 or end > count or start > end:
+            raise ValueError(f"{part.strip()} is not between 1 and {count}")
+        indexes += [index for index in range(start - 1, end) if index not in indexes]
+    return indexes
+
+
+def recreate_session(session):
+    return session, call_status(lambda s: client.post("/api/session/local", json=s), session)
+
+
+# Deletes the sessions in batches and creates the corrected ones again as soon as their batch is deleted
+def correct_sessions(sessions, session_store=None):
+    sessions_by_id = {session['id']: session for session in sessions}
+
+    def deleted_sessions():
+        for session_id, status in client.session_deleter(BATCH_SIZE).write(sessions_by_id):
+            if status == 200:
+                yield sessions_by_id[session_id]
+            else:
+                print(f"Error deleting session {session_id}: {status}")
+
+    corrected = 0
+    failed_sessions = []
+    for session, status in client.map(recreate_session, deleted_sessions()):
+        if status == 200:
+            corrected += 1
+            if session_store is not None:
+                session_store.put([session])
+        else:
+            print(f"Error creating session {session['id']}: {status}")
+            failed_sessions.append(session)
+            if session_store is not None:
+                session_store.remove([session['id']])
+
+    if failed_sessions:
+        with open(FAILED_SESSIONS_FILE, "w", encoding="utf-8") as f:
+            json.dump(failed_sessions, f, indent=2)
+        print(f"{len(failed_sessions)} sessions were deleted but could not be created again. They are saved in {FAILED_SESSIONS_FILE}.")
+    print(f"Corrected {corrected} of {len(sessions)} sessions")
+
+
+def bulk_main():
+    session_store = None
+    if SESSION_STORE_FILE is not None:
+        session_store = SessionStore(SESSION_STORE_FILE)
+        with metrics.phase("sync sessions"):
+            session_store.sync(client, [USER_ID], SESSIONS_PER_PAGE)
+        sessions = session_store.sessions(user_id=USER_ID)
+    else:
+        print("Fetching all sessions...")
+        sessions = list(client.iter_listening_sessions(USER_ID, SESSIONS_PER_PAGE))
+    sessions = [session for session in sessions if session['timeListening'] is not None]
+    if USE_ANOMALY_SCANNER:
+        sessions_by_id = {session['id']: session for session in sessions}
+        candidates = [candidate for candidate in scan(sessions) if candidate['action'] == "correct"]
+        matching = [sessions_by_id[candidate['id']] for candidate in candidates]
+        suggested_times = {candidate['id']: candidate['suggestedTimeListening'] for candidate in candidates}
+        print(f"{len(matching)} of {len(sessions)} sessions were flagged by the anomaly scanner")
+    else:
+        matching = [session for session in sessions if BULK_RULE(session)]
+        suggested_times = {session['id']: abs(session['currentTime'] - session['startTime']) for session in matching}
+        print(f"{len(matching)} of {len(sessions)} sessions match the rule")
+    # A session can not be corrected to no listening time at all (e.g. the position did not move), it is left as it is
+    skipped = [session for session in matching if suggested_times[session['id']] <= 0]
+    if len(skipped) > 0:
+        matching = [session for session in matching if suggested_times[session['id']] > 0]
+        print(f"Skipping {len(skipped)} sessions without a listening time to correct them to")
+    if len(matching) == 0:
+        return
+
+    for index, session in enumerate(matching, start=1):
+        suggested_time = suggested_times[session['id']]
+        print(f"{index}. {session['mediaMetadata']['title']} - {seconds_to_time_string(session['timeListening'])} -> {seconds_to_time_string(suggested_time)}")
+
+    while True:
+        user_input = input('\nType "exit", "all" or the sessions you want to correct (e.g. "1-20, 25"): ')
+        if user_input.lower() == 'exit':
+            return
+        try:
+            selected = [matching[index] for index in parse_selection(user_input, len(matching))]
+            break
+        except ValueError as e:
+            print(f"Invalid input: {e}")
+
+    for session in selected:
+        session['timeListening'] = suggested_times[session['id']]
+    correct_sessions(selected, session_store)
+
+
 def main():
     page_index = 0
 
@@ -120,4 +230,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if BULK_MODE or "--bulk" in sys.argv[1:]:
+        bulk_main()
+    else:
+        main()
@@ -0,0 +1,191 @@
+# This script calculates listening statistics for single users and the whole server (time per day, hour and weekday,
+# top books and devices, ...) from the listening sessions.
+# Sessions are synced into the local session store first, so only new and changed sessions are downloaded.
+# The sessions are then held as NumPy arrays (one array per field), so even millions of sessions take well under a second.
+# Needs NumPy: pip install numpy
+import json
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+from abs_client import AbsClient
+from run_metrics import metrics, write_metrics_at_exit
+from session_store import SessionStore
+
+# Configuration constants
+ABS_HOST = ""  # AudiobookShelf Host URL
+API_KEY = ""  # API Key of an admin user
+USER_IDS = []  # Users to calculate stats for. Keep empty to process all users.
+START_DATE = None  # First day to include, e.g. "2024-01-01". None for no limit.
+END_DATE = None  # Last day to include, e.g. "2024-12-31". None for no limit.
+TOP_ITEMS_COUNT = 10  # Number of books and devices in the top lists
+UTC_OFFSET_HOURS = None  # Time zone used for days and hours. None uses the time zone of this computer.
+SESSIONS_PER_PAGE = 500  # Number of sessions fetched per request while syncing
+SESSION_STORE_FILE = "sessions.sqlite"  # Sessions are kept in this file, so later runs only download new and changed ones
+OUTPUT_FILE = None  # Also write the stats as JSON to this file, e.g. "stats.json"
+METRICS_FILE = "listening_stats.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+MS_PER_DAY = 24 * 3600 * 1000
+
+
+# Maps every distinct value to a number. Returns the numbers as array and the values by number.
+def factorize(values):
+    codes = {}
+    array = np.fromiter((codes.setdefault(value, len(codes)) for value in values), dtype=np.int32)
+    return array, list(codes)
+
+
+# The sessions as one array per field. Text fields (user, book, device) are stored as numbers into a list of names.
+class SessionColumns:
+    def __init__(self, sessions):
+        self.ids = [session['id'] for session in sessions]
+        self.user, self.user_ids = factorize(session['userId'] for session in sessions)
+        self.item, self.item_ids = factorize(session.get('libraryItemId') for session in sessions)
+        self.device, self.device_names = factorize(device_name(session) for session in sessions)
+        self.time_listening = np.fromiter((session.get('timeListening') or 0 for session in sessions), dtype=np.float64, count=len(sessions))
+        self.started_at = np.fromiter((session.get('startedAt') or 0 for session in sessions), dtype=np.int64, count=len(sessions))
+        self.updated_at = np.fromiter((session.get('updatedAt') or 0 for session in sessions), dtype=np.int64, count=len(sessions))
+        self.start_time = np.fromiter((session.get('startTime') or 0 for session in sessions), dtype=np.float64, count=len(sessions))
+        self.current_time = np.fromiter((session.get('currentTime') or 0 for session in sessions), dtype=np.float64, count=len(sessions))
+
+        self.item_titles = [None] * len(self.item_ids)
+        for session, item in zip(sessions, self.item):
+            if self.item_titles[item] is None:
+                self.item_titles[item] = session.get('displayTitle') or (session.get('mediaMetadata') or {}).get('title') or "Unknown"
+
+    def __len__(self):
+        return len(self.time_listening)
+
+
+def device_name(session):
+    device_info = session.get('deviceInfo') or {}
+    if device_info.get('manufacturer') or device_info.get('model'):
+        return f"{device_info.get('manufacturer') or 'Unknown'} {device_info.get('model') or 'Device'}"
+    return device_info.get('clientName') or "Unknown"
+
+
+def local_offset_ms(utc_offset_hours):
+    if utc_offset_hours is None:
+        return time.localtime().tm_gmtoff * 1000
+    return int(utc_offset_hours * 3600 * 1000)
+
+
+# Returns the first millisecond of a day like "2024-01-31" in the configured time zone
+def day_start_ms(day, offset_ms):
+    return int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000) - offset_ms
+
+
+def top_entries(totals, names, count):
+    order = np.argsort(-totals, kind="stable")[:count]
+    return [(names[index], float(totals[index])) for index in order if totals[index] > 0]
+
+
+# Calculates the stats of the sessions selected by mask (all sessions if None)
+def calculate_stats(columns, mask=None, top_count=TOP_ITEMS_COUNT, offset_ms=0):
+    if mask is None:
+        mask = np.ones(len(columns), dtype=bool)
+    time_listening = columns.time_listening[mask]
+    local_ms = columns.started_at[mask] + offset_ms
+    days = local_ms // MS_PER_DAY
+    hour_of_day = (local_ms % MS_PER_DAY) // (3600 * 1000)
+    weekdays = (days + 3) % 7  # 1970-01-01 was a Thursday
+
+    stats = {
+        "totalListeningTime": float(time_listening.sum()),
+        "totalSessions": int(mask.sum()),
+        "medianSessionDuration": float(np.median(time_listening)) if len(time_listening) else 0.0,
+        "hourData": {hour: float(total) for hour, total in enumerate(np.bincount(hour_of_day, time_listening, minlength=24))},
+        "dayData": {WEEKDAYS[day]: float(total) for day, total in enumerate(np.bincount(weekdays, time_listening, minlength=7))},
+        "dailyData": {},
+        "topBooks": top_entries(np.bincount(columns.item[mask], time_listening, minlength=len(columns.item_ids)), columns.item_titles, top_count),
+        "topDevices": top_entries(np.bincount(columns.device[mask], minlength=len(columns.device_names)).astype(np.float64), columns.device_names, top_count),
+    }
+    if len(days):
+        first_day = int(days.min())
+        daily = np.bincount(days - first_day, time_listening)
+        epoch = date(1970, 1, 1)
+        stats["dailyData"] = {(epoch + timedelta(days=first_day + index)).isoformat(): float(total) for index, total in enumerate(daily) if total > 0}
+        stats["dailyAverage"] = stats["totalListeningTime"] / len(daily)
+    else:
+        stats["dailyAverage"] = 0.0
+    return stats
+
+
+# Server wide rollup: stats over all sessions plus the totals of every user
+def calculate_server_stats(columns, mask=None, top_count=TOP_ITEMS_COUNT, offset_ms=0):
+    if mask is None:
+        mask = np.ones(len(columns), dtype=bool)
+    stats = calculate_stats(columns, mask, top_count, offset_ms)
+    user_time = np.bincount(columns.user[mask], columns.time_listening[mask], minlength=len(columns.user_ids))
+    user_sessions = np.bincount(columns.user[mask], minlength=len(columns.user_ids))
+    stats["users"] = {user_id: {"totalListeningTime": float(user_time[index]), "totalSessions": int(user_sessions[index])}
+                      for index, user_id in enumerate(columns.user_ids)}
+    return stats
+
+
+def date_mask(columns, start_date, end_date, offset_ms):
+    mask = np.ones(len(columns), dtype=bool)
+    if start_date is not None:
+        mask &= columns.started_at >= day_start_ms(start_date, offset_ms)
+    if end_date is not None:
+        mask &= columns.started_at < day_start_ms(end_date, offset_ms) + MS_PER_DAY
+    return mask
+
+
+def hours(seconds):
+    return f"{seconds / 3600:.1f} h"
+
+
+def print_stats(title, stats):
+    print(f"\n--- {title} ---")
+    print(f"Listening time: {hours(stats['totalListeningTime'])} in {stats['totalSessions']} sessions "
+          f"(daily average {hours(stats['dailyAverage'])}, median session {stats['medianSessionDuration'] / 60:.0f} min)")
+    if stats['totalSessions'] == 0:
+        return
+    print("Weekdays: " + ", ".join(f"{day} {hours(total)}" for day, total in stats['dayData'].items()))
+    busiest_hour = max(stats['hourData'], key=stats['hourData'].get)
+    print(f"Most active hour: {busiest_hour}:00 ({hours(stats['hourData'][busiest_hour])})")
+    print("Top books:")
+    for book_title, total in stats['topBooks']:
+        print(f"  {book_title}: {hours(total)}")
+    print("Top devices:")
+    for device, count in stats['topDevices']:
+        print(f"  {device}: {count:.0f} sessions")
+
+
+if __name__ == "__main__":
+    write_metrics_at_exit(METRICS_FILE, "listening_stats")
+    client = AbsClient(ABS_HOST, API_KEY)
+    if len(USER_IDS) == 0:
+        USER_IDS = [user['id'] for user in client.get_users()]
+
+    session_store = SessionStore(SESSION_STORE_FILE)
+    with metrics.phase("sync sessions"):
+        session_store.sync(client, USER_IDS, SESSIONS_PER_PAGE)
+    with metrics.phase("read session store"):
+        sessions = [session for user_id in USER_IDS for session in session_store.sessions(user_id=user_id)]
+    session_store.close()
+
+    started = time.perf_counter()
+    with metrics.phase("load columns"):
+        columns = SessionColumns(sessions)
+    loaded = time.perf_counter()
+    offset_ms = local_offset_ms(UTC_OFFSET_HOURS)
+    mask = date_mask(columns, START_DATE, END_DATE, offset_ms)
+
+    with metrics.phase("calculate stats"):
+        report = {"server": calculate_server_stats(columns, mask, TOP_ITEMS_COUNT, offset_ms), "users": {}}
+        for index, user_id in enumerate(columns.user_ids):
+            report["users"][user_id] = calculate_stats(columns, mask & (columns.user == index), TOP_ITEMS_COUNT, offset_ms)
+    finished = time.perf_counter()
+
+    print_stats("Server", report["server"])
+    for user_id, stats in report["users"].items():
+        print_stats(f"User {user_id}", stats)
+    print(f"\nLoaded {len(columns)} sessions in {loaded - started:.2f}s, calculated the stats in {finished - loaded:.2f}s")
+
+    if OUTPUT_FILE is not None:
+        with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
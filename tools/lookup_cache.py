@@ -0,0 +1,101 @@
+# Local cache for metadata provider lookups (/api/search/books and /api/search/chapters).
+# Results are stored in a SQLite file keyed by (kind, provider, region, query), so re-runs and retries
+# of a partially failed run do not have to ask the provider again. Entries expire after a configurable TTL.
+# Only successful lookups with at least one result are cached.
+import json
+import sqlite3
+import threading
+import time
+
+from run_metrics import metrics
+
+DEFAULT_CACHE_FILE = "lookup_cache.sqlite"
+DEFAULT_TTL_DAYS = 30
+
+
+class LookupCache:
+    def __init__(self, path=DEFAULT_CACHE_FILE, ttl_days=DEFAULT_TTL_DAYS):
+        self.ttl = ttl_days * 24 * 3600
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS lookups (
+                kind TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                region TEXT NOT NULL,
+                query TEXT NOT NULL,
+                result TEXT NOT NULL,
+                createdAt REAL NOT NULL,
+                PRIMARY KEY (kind, provider, region, query)
+            )
+        """)
+        self.evict_expired()
+
+    def evict_expired(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM lookups WHERE createdAt < ?", (time.time() - self.ttl,))
+
+    def get(self, kind, provider, region, query):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result FROM lookups WHERE kind = ? AND provider = ? AND region = ? AND query = ? AND createdAt >= ?",
+                (kind, provider, region, query_key(query), time.time() - self.ttl),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, kind, provider, region, query, result):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO lookups (kind, provider, region, query, result, createdAt) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, provider, region, query_key(query), json.dumps(result), time.time()),
+            )
+
+    # Calls /api/search/<kind> with the given params unless the answer is cached. Returns (status_code, body).
+    # before_request is called right before a request is actually sent, e.g. to take a token of a rate limiter.
+    # Only successful answers are cached, errors are asked again on the next run.
+    def search(self, client, kind, provider, region, params, before_request=None):
+        cached = self.get(kind, provider, region, params)
+        if cached is not None:
+            metrics.increment(f"lookup cache hits ({kind})")
+            return 200, cached
+        metrics.increment(f"lookup cache misses ({kind})")
+
+        if before_request is not None:
+            before_request()
+        response = client.get(f"/api/search/{kind}", params=params)
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text
+        # Empty results count as failed lookups in the scripts, so they are asked again on the next run
+        if response.status_code == 200 and body and not (isinstance(body, dict) and body.get("error") is not None):
+            self.set(kind, provider, region, params, body)
+        return response.status_code, body
+
+    def close(self):
+        self.conn.close()
+
+
+# Does not cache anything, for when caching is disabled in a script
+class NoLookupCache(LookupCache):
+    def __init__(self):
+        pass
+
+    def get(self, kind, provider, region, query):
+        return None
+
+    def set(self, kind, provider, region, query, result):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_cache(path, ttl_days=DEFAULT_TTL_DAYS):
+    return NoLookupCache() if path is None else LookupCache(path, ttl_days)
+
+
+def query_key(query):
+    return json.dumps(query, sort_keys=True, ensure_ascii=False)
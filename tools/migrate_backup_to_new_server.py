@@ -7,24 +7,33 @@ import json
 import os
 import shutil
 import sqlite3
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_archive import DB_NAME, extract_database, repack_backup
+from run_metrics import metrics, write_metrics_at_exit
 
 # HOW TO USE:
 # 1. Make a backup :) - no, really, DO IT! - <your_domain>/config/backups - Then copy it somewhere not where this script runs!
 # 2. Download this backup (down arrow icon).
 # 3. Place the backup here (/tools) and rename it to "backup.audiobookshelf" (or change the BACKUP_FILE variable).
 # 4. Set the paths (see below for examples) - Make sure to use / and not \! READ THE PATHS SECTION CAREFULLY!
-# 5. Run the script - Your original file will now be replaced (a backup will be created, with the extension .bak). Check the last edited time to be sure.
-# 6. Once the script finishes, it will output "Migration complete." - When you see this, you can proceed with the next steps. Note: This could take time for large databases.
-# 7. Create your new server, create any user, and go to the backup section from step one. Then, upload the backup file.
-# 8. Now you can restore the backup, and your paths should be correct.
-# 9. IMPORTANT! Log out and log back in. Otherwise, the server will crash because the current user does not "exist" anymore.
+# 5. Optional: Run the script with --dry-run (or set DRY_RUN) to see what would change and how long it takes, without changing anything.
+# 6. Run the script - Your original file will now be replaced (a backup will be created, with the extension .bak). Check the last edited time to be sure.
+# 7. Once the script finishes, it will output "Migration complete." - When you see this, you can proceed with the next steps. Note: This could take time for large databases.
+# 8. Create your new server, create any user, and go to the backup section from step one. Then, upload the backup file.
+# 9. Now you can restore the backup, and your paths should be correct.
+# 10. IMPORTANT! Log out and log back in. Otherwise, the server will crash because the current user does not "exist" anymore.
 
 # PATHS:
-# 1. THIS SCRIPT CURRENTLY ONLY WORKS FOR SERVERS THAT SHARE THE SAME LOCATION FOR ALL LIBRARIES!
+# 1. Every library root you move needs an entry in LIBRARY_DIRS (old path -> new path).
 # -> Example: If you have a library "books" in /media/libraries/books and another library "podcasts" in
-# /media/libraries/podcasts, the script will work as both share the path /media/libraries/.
-# -> If you have a library "books" in /media/libraries/books and another library "podcasts" in /media/podcasts, the
-# script will not work, as the paths are different.
+# /media/libraries/podcasts, one entry for /media/libraries/ is enough, as both share this path.
+# -> If you have a library "books" in /media/libraries/books and another library "podcasts" in /media/podcasts, add
+# one entry for /media/libraries/books and one for /media/podcasts.
+# -> Every path is moved with the longest old path it starts with, so you can also move single folders inside a root.
 
 # THE PATHS MUST BE INPUT VERY PRECISELY! ENSURE YOU KNOW YOUR CURRENT PATHS!
 # For Docker, the default metadata path is /metadata.
@@ -48,21 +57,51 @@ BACKUP_FILE = "backup.audiobookshelf"
 OLD_METADATA_DIR = r"/metadata"  # Default for docker
 METADATA_DIR = r"C:\Users\<user>\Documents\metadata"
 
-OLD_LIBRARIES_DIR = r"/"  # Default for docker example
-LIBRARIES_DIR = r"C:\Users\<user>\Documents\libraries"
+# Old library path on your current server -> new path on your new server. Add as many entries as you need.
+LIBRARY_DIRS = {
+    r"/": r"C:\Users\<user>\Documents\libraries",  # Default for docker example
+}
 
-# ###### Code ####
+# Only extract the database and copy all other files (covers, metadata, ...) unchanged from the old into the new
+# backup, without unpacking and compressing them again. Set to False to unpack and repack the whole backup instead.
+STREAMING_REPACK = True
+
+# Only report how many rows would change, with a few examples per column, and estimate how long the migration takes.
+# The backup is not changed. Can also be enabled with --dry-run on the command line.
+DRY_RUN = False
+DRY_RUN_SAMPLES = 3  # Example values shown per column
+DRY_RUN_WORKERS = 4  # Columns checked at the same time, every check uses its own read-only connection
 
-# Create backup
-print("Creating a backup of the original backup file...")
-shutil.copy(BACKUP_FILE, f"{BACKUP_FILE}.bak")
+# How long every step of the migration took is written to <name>.json and <name>.prom (Prometheus textfile).
+# Set to None to disable.
+METRICS_FILE = "migrate_backup_to_new_server.metrics"
 
-# Unzip the backup
-print("Unzipping the backup...")
-shutil.unpack_archive(BACKUP_FILE, "backup", "zip")
+# ###### Code ####
+
+db_path = os.path.join("backup", DB_NAME)
+DRY_RUN = DRY_RUN or "--dry-run" in sys.argv[1:]
+write_metrics_at_exit(METRICS_FILE, "migrate_backup_to_new_server")
+
+if STREAMING_REPACK or DRY_RUN:
+    # Extract only the database, the original backup stays untouched until the new one is complete
+    print("Extracting the database from the backup...")
+    with metrics.phase("extract database"):
+        database = extract_database(BACKUP_FILE, "backup")
+    if database is None:
+        print("Error: No database found in backup")
+        exit()
+else:
+    # Create backup
+    print("Creating a backup of the original backup file...")
+    with metrics.phase("copy backup"):
+        shutil.copy(BACKUP_FILE, f"{BACKUP_FILE}.bak")
+
+    # Unzip the backup
+    print("Unzipping the backup...")
+    with metrics.phase("unpack backup"):
+        shutil.unpack_archive(BACKUP_FILE, "backup", "zip")
 
 # Check if the database exists
-db_path = os.path.join("backup", "absdatabase.sqlite")
 if not os.path.exists(db_path):
     print("Error: No database found in backup")
     exit()
@@ -71,6 +110,10 @@ if not os.path.exists(db_path):
 try:
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
+    # The database is an extracted copy and the original backup is kept, so durability is not needed here.
+    # The rollback journal stays in memory, so a failed migration can still be rolled back.
+    cur.execute("PRAGMA journal_mode = MEMORY")
+    cur.execute("PRAGMA synchronous = OFF")
     print("Connected to the database")
 except Exception as e:
     print("Error connecting to database:", e)
@@ -85,123 +128,274 @@ def clean_path(path):
     return tmp_path
 
 
-METADATA_DIR = clean_path(METADATA_DIR)
-LIBRARIES_DIR = clean_path(LIBRARIES_DIR)
-OLD_METADATA_DIR = clean_path(OLD_METADATA_DIR)
-OLD_LIBRARIES_DIR = clean_path(OLD_LIBRARIES_DIR)
-
-
-# Function to replace paths in the database
-def replace_path_in_db(table, column, old_path, new_path):
-    print(f"Replacing paths in {table}.{column} from {old_path} to {new_path}...")
-    if table == "playbackSessions":
-        print("This may take a long time with many users and/or started sessions.")
-
-    # Select only the rows that contain the old_path to minimize data fetched
-    select_sql = f"SELECT id, {column} FROM {table} WHERE {column} LIKE ?"
-    cur.execute(select_sql, (f'%{old_path}%',))
-    rows = cur.fetchall()
-
-    # Prepare updates
-    updates = []
-    for row_id, row_column in rows:
-        if row_column is not None:
-            # Replace only the first occurrence
-            new_column = row_column.replace(old_path, new_path, 1)
-            if new_column != row_column:
-                updates.append((new_column, row_id))
-
-    # Execute updates in a single batch
-    update_sql = f"UPDATE {table} SET {column} = ? WHERE id = ?"
-    cur.executemany(update_sql, updates)
-    conn.commit()
-
+# Prefix trie of all old paths. Finds the longest old path a path starts with in one walk over the path,
+# no matter how many old paths there are.
+class PathTrie:
+    def __init__(self, mappings):
+        self.root = {}
+        for old_path, new_path in mappings.items():
+            node = self.root
+            for char in old_path:
+                node = node.setdefault(char, {})
+            node[None] = (old_path, new_path)
+
+    def longest_match(self, path):
+        match = None
+        node = self.root
+        for char in path:
+            if None in node:
+                match = node[None]
+            node = node.get(char)
+            if node is None:
+                return match
+        return node.get(None, match)
+
+    # Returns the path moved to its new root, or None if it is not inside any old root.
+    # Old roots end with "/", the "/" appended here lets a root folder itself (without "/") match as well.
+    def map_path(self, path):
+        if not isinstance(path, str):
+            return None
+        match = self.longest_match(path + "/")
+        if match is None:
+            return None
+        old_path, new_path = match
+        return (new_path + (path + "/")[len(old_path):])[:-1]
+
+
+PATH_MAPPINGS = {clean_path(old_path): clean_path(new_path) for old_path, new_path in LIBRARY_DIRS.items()}
+PATH_MAPPINGS[clean_path(OLD_METADATA_DIR)] = clean_path(METADATA_DIR)
+path_trie = PathTrie(PATH_MAPPINGS)
+conn.create_function("map_path", 1, path_trie.map_path, deterministic=True)
+
+for old_path, new_path in PATH_MAPPINGS.items():
+    print(f"Moving {old_path} to {new_path}")
+
+
+# Returns the smallest string that is larger than every string starting with prefix
+def prefix_upper_bound(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+# SQL condition that is true for every value inside one of the old roots (and a few more, map_path has the final say).
+# It consists of one range per root, so SQLite can use an index on the column and skips all other rows.
+def root_ranges_condition(expression):
+    ranges = " OR ".join(f"({expression} >= ? AND {expression} < ?)" for _ in PATH_MAPPINGS)
+    params = [bound for old_path in PATH_MAPPINGS for bound in (old_path[:-1], prefix_upper_bound(old_path))]
+    return f"({ranges})", params
+
+
+# Function to replace paths in the database. Every value is moved to its new root by SQLite itself, without loading any rows.
+def replace_path_in_db(table, column):
+    print(f"Replacing paths in {table}.{column}...")
+    ranges, params = root_ranges_condition(column)
+    update_sql = f"UPDATE {table} SET {column} = map_path({column}) WHERE {ranges} AND map_path({column}) IS NOT NULL"
+    cur.execute(update_sql, params)
+    print(f"Updated {cur.rowcount} rows")
+
+
+# Relevant tables and columns that contain a path
+# Covers can be in the metadata folder or next to the book, every column is mapped with all roots
+PATH_COLUMNS = [
+    ('authors', 'imagePath'),
+    ('books', 'coverPath'),
+    ('feeds', 'coverPath'),
+    ('playbackSessions', 'coverPath'),
+    ('podcasts', 'coverPath'),
+    ('feedEpisodes', 'filePath'),
+    ('libraryFolders', 'path'),
+    ('libraryItems', 'path'),
+]
+
+# JSON columns that contain file objects with a metadata.path, either as a list of files or a single file
+JSON_FILE_COLUMNS = [
+    ('books', 'audioFiles', True),
+    ('books', 'ebookFile', False),
+    ('libraryItems', 'libraryFiles', True),
+    ('podcastEpisodes', 'audioFile', False),
+]
+JSON_FALLBACK_CHUNK_SIZE = 1000  # Rows read per query when SQLite has no JSON support
+
+
+def has_json1(cursor=cur):
+    try:
+        cursor.execute("SELECT json('[]')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+# Moves the paths of the file objects inside SQLite with json_each/json_set. Rows without a matching path are not touched.
+def replace_json_paths_sql(table, column, is_list):
+    if is_list:
+        path = "json_extract(file.value, '$.metadata.path')"
+        update_sql = f"""
+            UPDATE {table} SET {column} = (
+                SELECT json_group_array(json(CASE WHEN map_path({path}) IS NOT NULL
+                    THEN json_set(file.value, '$.metadata.path', map_path({path}))
+                    ELSE file.value END))
+                FROM json_each({table}.{column}) AS file
+            )
+            WHERE EXISTS (SELECT 1 FROM json_each({table}.{column}) AS file WHERE map_path({path}) IS NOT NULL)
+        """
+    else:
+        path = f"json_extract({column}, '$.metadata.path')"
+        update_sql = f"""
+            UPDATE {table} SET {column} = json_set({column}, '$.metadata.path', map_path({path}))
+            WHERE map_path({path}) IS NOT NULL
+        """
+    cur.execute(update_sql)
+    return cur.rowcount
+
+
+def replace_file_path(file):
+    new_path = path_trie.map_path((file.get('metadata') or {}).get('path'))
+    if new_path is None:
+        return False
+    file['metadata']['path'] = new_path
+    return True
+
+
+# Fallback without JSON support in SQLite: reads the rows in chunks ordered by id and only writes back rows that changed
+def replace_json_paths_python(table, column, is_list):
+    updated = 0
+    last_id = ""
+    while True:
+        cur.execute(
+            f"SELECT id, {column} FROM {table} WHERE id > ? AND {column} IS NOT NULL ORDER BY id LIMIT ?",
+            (last_id, JSON_FALLBACK_CHUNK_SIZE),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return updated
+
+        update_params = []
+        for row_id, value in rows:
+            files = json.loads(value)
+            changed = [replace_file_path(file) for file in (files if is_list else [files])]
+            if any(changed):
+                update_params.append((json.dumps(files), row_id))
+        cur.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", update_params)
+        updated += len(update_params)
+        last_id = rows[-1][0]
+
+
+# Opens the extracted database read-only, so the checks of a dry run can never change it
+def connect_read_only():
+    db = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True, check_same_thread=False)
+    db.create_function("map_path", 1, path_trie.map_path, deterministic=True)
+    return db
+
+
+# Counts the values of a path column that would change and returns a few of them with their new value
+def check_path_column(db, table, column):
+    ranges, params = root_ranges_condition(column)
+    condition = f"WHERE {ranges} AND map_path({column}) IS NOT NULL"
+    count = db.execute(f"SELECT count(*) FROM {table} {condition}", params).fetchone()[0]
+    samples = db.execute(f"SELECT {column}, map_path({column}) FROM {table} {condition} LIMIT ?", params + [DRY_RUN_SAMPLES]).fetchall()
+    return count, samples
+
+
+# Same for a JSON column with file objects. The examples are single file paths, not whole rows.
+def check_json_column(db, table, column, is_list):
+    if not has_json1(db.cursor()):
+        count = 0
+        samples = []
+        for (value,) in db.execute(f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL"):
+            files = json.loads(value)
+            old_paths = [(file.get('metadata') or {}).get('path') for file in (files if is_list else [files])]
+            changed = [(old_path, path_trie.map_path(old_path)) for old_path in old_paths if path_trie.map_path(old_path) is not None]
+            count += 1 if changed else 0
+            samples += changed[:DRY_RUN_SAMPLES - len(samples)]
+        return count, samples
+
+    if is_list:
+        path = "json_extract(file.value, '$.metadata.path')"
+        count_sql = f"SELECT count(*) FROM {table} WHERE EXISTS (SELECT 1 FROM json_each({table}.{column}) AS file WHERE map_path({path}) IS NOT NULL)"
+        sample_sql = f"SELECT {path}, map_path({path}) FROM {table}, json_each({table}.{column}) AS file WHERE map_path({path}) IS NOT NULL LIMIT ?"
+    else:
+        path = f"json_extract({column}, '$.metadata.path')"
+        count_sql = f"SELECT count(*) FROM {table} WHERE map_path({path}) IS NOT NULL"
+        sample_sql = f"SELECT {path}, map_path({path}) FROM {table} WHERE map_path({path}) IS NOT NULL LIMIT ?"
+    return db.execute(count_sql).fetchone()[0], db.execute(sample_sql, (DRY_RUN_SAMPLES,)).fetchall()
+
+
+# Runs one check with its own connection and measures how long it took
+def run_check(check, table, column, *args):
+    db = connect_read_only()
+    try:
+        started = time.perf_counter()
+        count, samples = check(db, table, column, *args)
+        return table, column, count, samples, time.perf_counter() - started
+    finally:
+        db.close()
+
+
+# Time to compress the database into the new backup, measured on its first 16 MB
+def estimate_compress_seconds():
+    size = os.path.getsize(db_path)
+    with open(db_path, "rb") as db_file:
+        data = db_file.read(16 * 1024 * 1024)
+    if not data:
+        return 0.0
+    started = time.perf_counter()
+    zlib.compress(data, zlib.Z_DEFAULT_COMPRESSION)
+    return (time.perf_counter() - started) * size / len(data)
+
+
+def dry_run_report():
+    print(f"Dry run: checking {len(PATH_COLUMNS) + len(JSON_FILE_COLUMNS)} columns with {DRY_RUN_WORKERS} workers...")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=DRY_RUN_WORKERS) as executor:
+        futures = [executor.submit(run_check, check_path_column, table, column) for table, column in PATH_COLUMNS]
+        futures += [executor.submit(run_check, check_json_column, table, column, is_list) for table, column, is_list in JSON_FILE_COLUMNS]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    total_rows = 0
+    serial_seconds = 0.0
+    for table, column, count, samples, seconds in results:
+        total_rows += count
+        serial_seconds += seconds
+        print(f"\n{table}.{column}: {count} rows would change ({seconds:.2f}s)")
+        for old_value, new_value in samples:
+            print(f"  {old_value}\n  -> {new_value}")
+
+    db = connect_read_only()
+    for key, value in db.execute("SELECT \"key\", \"value\" FROM settings WHERE \"key\" = 'server-settings'"):
+        backup_path = json.loads(value).get('backupPath')
+        print(f"\nsettings.{key}: backupPath {backup_path}\n  -> {path_trie.map_path(backup_path) or backup_path}")
+    db.close()
+
+    # The migration runs the same queries one after another and additionally writes the changed rows
+    compress_seconds = estimate_compress_seconds()
+    print(f"\n{total_rows} rows would change. Checked in {elapsed:.2f}s ({serial_seconds:.2f}s one after another).")
+    print(f"Estimated migration time: more than {serial_seconds + compress_seconds:.1f}s "
+          f"({serial_seconds:.1f}s to find and map the rows, {compress_seconds:.1f}s to compress the database), "
+          f"plus writing the changed rows and copying the other files of the backup.")
+
+
+if DRY_RUN:
+    conn.close()
+    with metrics.phase("dry run checks"):
+        dry_run_report()
+    shutil.rmtree("backup")
+    print("\nDry run complete, nothing was changed.")
+    exit()
 
 # Replace paths in relevant tables and columns
-replace_path_in_db('authors', 'imagePath', OLD_METADATA_DIR, METADATA_DIR)
-replace_path_in_db('books', 'coverPath', OLD_METADATA_DIR, METADATA_DIR)
-replace_path_in_db('feeds', 'coverPath', OLD_METADATA_DIR, METADATA_DIR)
-replace_path_in_db('playbackSessions', 'coverPath', OLD_METADATA_DIR, METADATA_DIR)
-replace_path_in_db('podcasts', 'coverPath', OLD_METADATA_DIR, METADATA_DIR)
-
-replace_path_in_db('feedEpisodes', 'filePath', OLD_LIBRARIES_DIR, LIBRARIES_DIR)
-replace_path_in_db('libraryFolders', 'path', OLD_LIBRARIES_DIR, LIBRARIES_DIR)
-replace_path_in_db('libraryItems', 'path', OLD_LIBRARIES_DIR, LIBRARIES_DIR)
+for table, column in PATH_COLUMNS:
+    with metrics.phase(f"map paths {table}.{column}"):
+        replace_path_in_db(table, column)
 
 print("Correcting files in db. This can take a while...")
+replace_json_paths = replace_json_paths_sql if has_json1() else replace_json_paths_python
+if replace_json_paths is replace_json_paths_python:
+    print("SQLite has no JSON support, falling back to rewriting the files in Python")
 
-# Correct book files
-sql = "SELECT id, audioFiles, ebookFile FROM books"
-cur.execute(sql)
-book_rows = cur.fetchall()
-
-update_params = []
-
-for book_id, audio_files, ebook_file in book_rows:
-    new_audio_files = None
-    new_ebook_file = None
-
-    if audio_files is not None:
-        audio_files = json.loads(audio_files)
-        for audio_file in audio_files:
-            audio_file['metadata']['path'] = audio_file['metadata']['path'].replace(OLD_LIBRARIES_DIR, LIBRARIES_DIR, 1)
-        new_audio_files = json.dumps(audio_files)
-
-    if ebook_file is not None:
-        ebook_file = json.loads(ebook_file)
-        ebook_file['metadata']['path'] = ebook_file['metadata']['path'].replace(OLD_LIBRARIES_DIR, LIBRARIES_DIR, 1)
-        new_ebook_file = json.dumps(ebook_file)
-
-    update_params.append((new_audio_files, new_ebook_file, book_id))
-
-sql_update = "UPDATE books SET audioFiles = ?, ebookFile = ? WHERE id = ?"
-cur.executemany(sql_update, update_params)
-conn.commit()
-
-
-# Correct libraryItems
-sql = "SELECT id, libraryFiles FROM libraryItems"
-cur.execute(sql)
-lib_rows = cur.fetchall()
-
-update_params = []
-
-for item_id, library_files in lib_rows:
-    new_library_files = None
-
-    if library_files is not None:
-        library_files = json.loads(library_files)
-        for library_file in library_files:
-            library_file['metadata']['path'] = library_file['metadata']['path'].replace(OLD_LIBRARIES_DIR, LIBRARIES_DIR, 1)
-        new_library_files = json.dumps(library_files)
-
-    update_params.append((new_library_files, item_id))
-
-sql_update = "UPDATE libraryItems SET libraryFiles = ? WHERE id = ?"
-cur.executemany(sql_update, update_params)
-conn.commit()
-
-
-# Correct podcast files
-sql = "SELECT id, audioFile FROM podcastEpisodes"
-cur.execute(sql)
-podcast_rows = cur.fetchall()
-
-update_params = []
-
-for episode_id, audio_file in podcast_rows:
-    new_audio_file = None
-
-    if audio_file is not None:
-        audio_file = json.loads(audio_file)
-        audio_file['metadata']['path'] = audio_file['metadata']['path'].replace(OLD_LIBRARIES_DIR, LIBRARIES_DIR, 1)
-        new_audio_file = json.dumps(audio_file)
-
-    update_params.append((new_audio_file, episode_id))
-
-sql_update = "UPDATE podcastEpisodes SET audioFile = ? WHERE id = ?"
-cur.executemany(sql_update, update_params)
-conn.commit()
+for table, column, is_list in JSON_FILE_COLUMNS:
+    print(f"Replacing file paths in {table}.{column}...")
+    with metrics.phase(f"map file paths {table}.{column}"):
+        print(f"Updated {replace_json_paths(table, column, is_list)} rows")
 
 
 # Correct server settings
@@ -211,22 +405,32 @@ settings_rows = cur.fetchall()
 for key, value in settings_rows:
     if key == "server-settings":
         json_content = json.loads(value)
-        json_content['backupPath'] = json_content['backupPath'].replace(OLD_METADATA_DIR, METADATA_DIR, 1)
+        json_content['backupPath'] = path_trie.map_path(json_content['backupPath']) or json_content['backupPath']
         new_value = json.dumps(json_content)
         print(f"Updating server settings: {key}")
         sql = "UPDATE settings SET value = ? WHERE key = ?"
         cur.execute(sql, (new_value, key))
-        conn.commit()
+
+# All changes are written in one transaction
+with metrics.phase("commit"):
+    conn.commit()
 
 # Close the database connection
 conn.close()
 
+
 # Repack the backup
 print("Repacking the backup...")
-shutil.make_archive("backup", 'zip', "backup")
-
-# Rename the newly packed archive to the original backup file name
-os.replace("backup.zip", BACKUP_FILE)
+if STREAMING_REPACK:
+    # Keeps the original backup as .bak and puts the new one in its place
+    with metrics.phase("repack backup"):
+        repack_backup(BACKUP_FILE, db_path)
+else:
+    with metrics.phase("repack backup"):
+        shutil.make_archive("backup", 'zip', "backup")
+
+    # Rename the newly packed archive to the original backup file name
+    os.replace("backup.zip", BACKUP_FILE)
 
 # Clean up the extracted backup folder
 shutil.rmtree("backup")
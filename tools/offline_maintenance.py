@@ -0,0 +1,147 @@
+# This script runs maintenance tasks directly on the database of a backup instead of going through the API of the server.
+# It can remove authors without books, delete listening sessions that are larger than a threshold and split genres
+# that contain ", " into multiple genres. Every task is a single SQL statement, so even large libraries take seconds.
+# KEEP A BACKUP OF YOUR DATA BEFORE RUNNING THIS SCRIPT! IT WILL CREATE A BACKUP, BUT BETTER SAFE THAN SORRY!
+
+import json
+import shutil
+import sqlite3
+import sys
+
+from backup_archive import extract_database, repack_backup
+from run_metrics import metrics, write_metrics_at_exit
+
+# HOW TO USE:
+# 1. Make a backup - <your_domain>/config/backups - and download it (down arrow icon).
+# 2. Place the backup here (/tools) and rename it to "backup.audiobookshelf" (or change the BACKUP_FILE variable).
+# 3. Choose the tasks below and run the script. Your original file will be kept with the extension .bak.
+# 4. Upload the changed backup in the backup section of your server and restore it.
+# 5. Log out and log back in.
+
+# ##### Configuration ####
+
+BACKUP_FILE = "backup.audiobookshelf"
+DRY_RUN = False  # Only report what would change, the backup is not changed. Can also be enabled with --dry-run.
+METRICS_FILE = "offline_maintenance.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
+
+REMOVE_EMPTY_AUTHORS = True  # Delete all authors that have no books associated with them
+LIBRARY_IDS = []  # Libraries to remove empty authors from. Leave empty to process all libraries.
+
+DELETE_LONG_SESSIONS = True  # Delete all listening sessions that are larger than LISTENING_SESSION_THRESHOLD
+LISTENING_SESSION_THRESHOLD = 16  # Threshold in hours. Everything larger than this will be deleted.
+USER_IDS = []  # Users whose sessions are processed. Leave empty to process all users.
+
+SPLIT_GENRES = True  # Split genres that contain ", " into multiple genres
+SKIP_GENRES = ['Mystery, Thriller & Suspense']  # Genres to skip
+
+# ###### Code ####
+
+DRY_RUN = DRY_RUN or "--dry-run" in sys.argv[1:]
+EXTRACT_DIR = "backup"
+
+
+# Returns the genres with every multi genre replaced by its single genres, keeping the order.
+# Registered as SQL function, so SQLite calls it only for the books that need it.
+def split_genres(genres_json):
+    genres = json.loads(genres_json)
+    split = []
+    for genre in genres:
+        parts = genre.split(", ") if isinstance(genre, str) and ", " in genre and genre not in SKIP_GENRES else [genre]
+        for part in parts:
+            if part not in split:
+                split.append(part)
+    return json.dumps(split)
+
+
+# Returns the condition and parameters that limit a column to the given ids, or no limit if there are none
+def in_ids(column, ids):
+    if len(ids) == 0:
+        return "1", []
+    return f"{column} IN ({', '.join('?' for _ in ids)})", list(ids)
+
+
+def remove_empty_authors(cur):
+    libraries, params = in_ids("libraryId", LIBRARY_IDS)
+    cur.execute(f"DELETE FROM authors WHERE {libraries} AND id NOT IN (SELECT authorId FROM bookAuthors)", params)
+    print(f"Removed {cur.rowcount} authors without books")
+
+
+def delete_long_sessions(cur):
+    users, params = in_ids("userId", USER_IDS)
+    cur.execute(
+        f"SELECT total(timeListening) / 3600 FROM playbackSessions WHERE {users} AND timeListening > ?",
+        params + [LISTENING_SESSION_THRESHOLD * 3600],
+    )
+    hours = cur.fetchone()[0]
+    cur.execute(f"DELETE FROM playbackSessions WHERE {users} AND timeListening > ?", params + [LISTENING_SESSION_THRESHOLD * 3600])
+    print(f"Deleted {cur.rowcount} listening sessions larger than {LISTENING_SESSION_THRESHOLD} hours ({hours:.1f} hours in total)")
+
+
+# Books and podcasts both have genres, split_genres.py also splits them on the items of podcast libraries
+def split_multi_genres(cur):
+    skip = ", ".join("?" for _ in SKIP_GENRES) or "NULL"
+    for table in ("books", "podcasts"):
+        cur.execute(
+            f"""
+            UPDATE {table} SET genres = split_genres(genres), updatedAt = strftime('%Y-%m-%d %H:%M:%f +00:00', 'now')
+            WHERE json_valid(genres) AND EXISTS (
+                SELECT 1 FROM json_each({table}.genres) AS genre
+                WHERE instr(genre.value, ', ') > 0 AND genre.value NOT IN ({skip})
+            )
+            """,
+            SKIP_GENRES,
+        )
+        print(f"Split the genres of {cur.rowcount} {table}")
+
+
+write_metrics_at_exit(METRICS_FILE, "offline_maintenance")
+
+print("Extracting the database from the backup...")
+with metrics.phase("extract database"):
+    db_path = extract_database(BACKUP_FILE, EXTRACT_DIR)
+if db_path is None:
+    print("Error: No database found in backup")
+    exit()
+
+conn = sqlite3.connect(db_path)
+# The database is an extracted copy and the original backup is kept, so durability is not needed here
+conn.execute("PRAGMA journal_mode = MEMORY")
+conn.execute("PRAGMA synchronous = OFF")
+conn.create_function("split_genres", 1, split_genres, deterministic=True)
+cur = conn.cursor()
+
+# All tasks run in one transaction, so the database is either changed completely or not at all
+try:
+    if REMOVE_EMPTY_AUTHORS:
+        with metrics.phase("remove empty authors"):
+            remove_empty_authors(cur)
+    if DELETE_LONG_SESSIONS:
+        with metrics.phase("delete long sessions"):
+            delete_long_sessions(cur)
+    if SPLIT_GENRES:
+        with metrics.phase("split genres"):
+            split_multi_genres(cur)
+except sqlite3.Error as e:
+    conn.rollback()
+    conn.close()
+    shutil.rmtree(EXTRACT_DIR)
+    print("Error running the maintenance tasks, nothing was changed:", e)
+    exit()
+
+if DRY_RUN:
+    conn.rollback()
+    conn.close()
+    shutil.rmtree(EXTRACT_DIR)
+    print("Dry run complete, nothing was changed.")
+    exit()
+
+with metrics.phase("commit"):
+    conn.commit()
+conn.close()
+
+print("Repacking the backup...")
+with metrics.phase("repack backup"):
+    repack_backup(BACKUP_FILE, db_path)
+shutil.rmtree(EXTRACT_DIR)
+
+print("Maintenance complete.")
@@ -1,12 +1,23 @@
-import requests
 import json
-import os
+import unicodedata
+from collections import defaultdict
+
+from abs_client import AbsClient, HttpClient, chunked
+from run_metrics import write_metrics_at_exit
 
 absHost = 'http://localhost:3333'
 absToken = ''
 plexHost = 'http://localhost:32400'
 plexToken = '' # Not tested. I don't needed one (I assume it has something to do when connecting with a plex account/claim)
 plexSectionId = 1  # Tbh no idea what this is for, for me it's one
+progressBatchSize = 100  # Number of progress updates sent per request
+batchGetSize = 250  # Number of AudiobookShelf items fetched per request. Lower it if the requests time out.
+plexPageSize = 500  # Number of Plex items fetched per request
+verbosity = 1  # 0: only print the summary, 1: also print every match and skipped item, 2: also dump every Plex item as JSON
+matchOnSize = True  # Use the file size to decide between AudiobookShelf items that contain a file with the same name
+matchOnDuration = True  # Use the track duration to decide between AudiobookShelf items that contain a file with the same name
+durationTolerance = 2  # Seconds the durations may differ to still count as the same file
+metricsFile = 'plexToAbs.metrics'  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
 params = {
     'X-Plex-Token': plexToken,
     'type': 10,
@@ -16,45 +27,104 @@ params = {
     'includeMeta': 1,
 }
 
-absHeaders = {
-    'Authorization': f'Bearer {absToken}',
-    'Accept': 'application/json',
-}
-
-absLibraries = requests.get(f"{absHost}/api/libraries?token={absToken}", timeout=30, headers=absHeaders)
-absLibraries.raise_for_status()
+write_metrics_at_exit(metricsFile, 'plexToAbs')
+absClient = AbsClient(absHost, absToken)
+plexClient = HttpClient(plexHost)
 
-allLibraryIds = [library['id'] for library in absLibraries.json()['libraries']]
+allLibraryIds = [library['id'] for library in absClient.get_libraries()]
 
 libraryItemsId = []
 
-for libraryId in allLibraryIds:
-    libraryItemsResponse = requests.get(f"{absHost}/api/libraries/{libraryId}/items?token={absToken}", timeout=30, headers=absHeaders)
-    libraryItemsResponse.raise_for_status()
-    libraryItemsId.extend([item['id'] for item in libraryItemsResponse.json()['results']])
+# Libraries are independent, so their item lists are fetched concurrently
+for libraryItemsResponse in absClient.map(lambda libraryId: absClient.get_json(f"/api/libraries/{libraryId}/items"), allLibraryIds):
+    libraryItemsId.extend([item['id'] for item in libraryItemsResponse['results']])
 
-print('Fetching items from AudiobookShelf... (this may take a while)')
-itemResponse = requests.post(f"{absHost}/api/items/batch/get?token={absToken}", json={
-                             'libraryItemIds': libraryItemsId}, timeout=6000, headers=absHeaders)
-itemResponse.raise_for_status()
-libraryItems = itemResponse.json()['libraryItems']
 print(f"Found {len(libraryItemsId)} items in AudiobookShelf with IDs")
 
 
-plexItemResponse = requests.get(f"{plexHost}/library/sections/{plexSectionId}/all", params=params, timeout=30, headers={
-    'Accept': 'application/json'
-})
-plexItemResponse.raise_for_status()
-plexItems = plexItemResponse.json()["MediaContainer"]["Metadata"]
+# Plex may report Windows paths, so both separators are handled regardless of the OS this script runs on
+def normalizeBasename(path):
+    return unicodedata.normalize('NFC', path.replace('\\', '/').rsplit('/', 1)[-1]).casefold()
+
+
+# normalized basename -> [(libraryItemId, size, duration)] for every file of every AudiobookShelf item
+absFileIndex = defaultdict(list)
+absItemTitles = {}
+
+
+def indexLibraryItem(libraryItem):
+    libraryItemId = libraryItem['id']
+    absItemTitles[libraryItemId] = libraryItem['media']['metadata']['title']
+    durations = {audioFile['metadata']['path']: audioFile.get('duration') for audioFile in libraryItem['media'].get('audioFiles') or []}
+    for libraryFile in libraryItem['libraryFiles']:
+        path = libraryFile['metadata']['path']
+        absFileIndex[normalizeBasename(path)].append((libraryItemId, libraryFile['metadata'].get('size'), durations.get(path)))
+
+
+# Keeps only the candidates matching the predicate, as long as that still leaves at least one item
+def narrowCandidates(candidates, predicate):
+    if len({candidate[0] for candidate in candidates}) <= 1:
+        return candidates
+    narrowed = [candidate for candidate in candidates if predicate(candidate)]
+    return narrowed or candidates
+
 
-print(f"Found {len(libraryItems)} items in AudiobookShelf")
-print(f"Found {len(plexItems)} items in Plex")
+# Returns the ids of all AudiobookShelf items that contain the file of the Plex track
+def findLibraryItemIds(plexTrack):
+    candidates = absFileIndex.get(normalizeBasename(plexTrack['file']), [])
+    plexSize = plexTrack.get('size')
+    plexTrackDuration = plexTrack.get('duration')
+    if matchOnSize and plexSize is not None:
+        candidates = narrowCandidates(candidates, lambda candidate: candidate[1] == plexSize)
+    if matchOnDuration and plexTrackDuration is not None:
+        candidates = narrowCandidates(candidates, lambda candidate: candidate[2] is not None and abs(candidate[2] - plexTrackDuration / 1000) <= durationTolerance)
+    return {candidate[0] for candidate in candidates}
+
+
+# Fetches the full items of one chunk of ids. Only the index is kept, so at most a few chunks are held in memory.
+def fetchLibraryItems(libraryItemIdsChunk):
+    itemResponse = absClient.post("/api/items/batch/get", json={'libraryItemIds': libraryItemIdsChunk})
+    itemResponse.raise_for_status()
+    return itemResponse.json()['libraryItems']
+
+
+print('Fetching items from AudiobookShelf... (this may take a while)')
+for libraryItems in absClient.map(fetchLibraryItems, chunked(libraryItemsId, batchGetSize)):
+    for libraryItem in libraryItems:
+        indexLibraryItem(libraryItem)
+    print(f"Fetched {len(absItemTitles)}/{len(libraryItemsId)} items")
+print(f"Indexed {sum(len(files) for files in absFileIndex.values())} files of {len(absItemTitles)} items")
+
+
+# Yields the items of the Plex section page by page, so matching starts as soon as the first page arrived
+def iterPlexItems():
+    start = 0
+    while True:
+        plexItemResponse = plexClient.get(f"/library/sections/{plexSectionId}/all", params=params, headers={
+            'X-Plex-Container-Start': str(start),
+            'X-Plex-Container-Size': str(plexPageSize),
+        })
+        plexItemResponse.raise_for_status()
+        mediaContainer = plexItemResponse.json()["MediaContainer"]
+        plexItems = mediaContainer.get("Metadata", [])
+        yield from plexItems
+        start += len(plexItems)
+        if len(plexItems) < plexPageSize or start >= mediaContainer.get("totalSize", start + 1):
+            break
+
+
+print(f"Found {len(absItemTitles)} items in AudiobookShelf")
+plexItemCount = 0
 
 progressUpdates = []
+unmatchedItems = []
+ambiguousItems = []
 
-for plexItem in plexItems:
+for plexItem in iterPlexItems():
+    plexItemCount += 1
     plexTrack = plexItem["Media"][0]["Part"][0]
-    print(json.dumps(plexItem, indent=2))
+    if verbosity >= 2:
+        print(json.dumps(plexItem, indent=2))
     plexDuration = plexItem.get("duration", 0)
     plexOffset = plexItem.get("viewOffset")
     if plexOffset is None:
@@ -65,31 +135,43 @@ for plexItem in plexItems:
         (plexOffset / plexDuration * 100) if plexDuration > 0 else 0)
 
     if plexViewedAt is None:
-        print(f"Skipping item {plexItem['title']} - no viewedAt timestamp")
+        if verbosity >= 1:
+            print(f"Skipping item {plexItem['title']} - no viewedAt timestamp")
         continue
 
-    for libraryItem in libraryItems:
-        libraryFiles = libraryItem["libraryFiles"]
-
-        for libraryFile in libraryFiles:
-            if os.path.basename(libraryFile["metadata"]["path"]) == os.path.basename(plexTrack["file"]):
-                print(f"Found match: {libraryItem['media']['metadata']['title']} ({libraryItem['id']})")
-
-                progressUpdates.append({
-                    "libraryItemId": libraryItem['id'],
-                    "duration": plexDuration / 1000,
-                    "progress": plexPercent / 100,
-                    "currentTime": plexOffset / 1000,
-                    "isFinished": plexPercent >= 100,
-                    "finishedAt": None if plexPercent < 100 else plexViewedAt,
-                    "startedAt": plexViewedAt,
-                })
-
-                break
-
-print(f"Found {len(progressUpdates)} items to update progress for")
-updateRequest = requests.patch(f"{absHost}/api/me/progress/batch/update", json=progressUpdates, timeout=6000, headers=absHeaders)
-if updateRequest.status_code != 200:
-    print(f"Error updating progress: {updateRequest.status_code} - {updateRequest.text}")
+    libraryItemIds = findLibraryItemIds(plexTrack)
+    if len(libraryItemIds) == 0:
+        unmatchedItems.append(plexItem['title'])
+        continue
+    if len(libraryItemIds) > 1:
+        ambiguousItems.append((plexItem['title'], libraryItemIds))
+        continue
+
+    libraryItemId = libraryItemIds.pop()
+    if verbosity >= 1:
+        print(f"Found match: {absItemTitles[libraryItemId]} ({libraryItemId})")
+
+    progressUpdates.append({
+        "libraryItemId": libraryItemId,
+        "duration": plexDuration / 1000,
+        "progress": plexPercent / 100,
+        "currentTime": plexOffset / 1000,
+        "isFinished": plexPercent >= 100,
+        "finishedAt": None if plexPercent < 100 else plexViewedAt,
+        "startedAt": plexViewedAt,
+    })
+
+print(f"\nFound {plexItemCount} items in Plex")
+print(f"No AudiobookShelf item found for {len(unmatchedItems)} Plex items:")
+for title in unmatchedItems:
+    print(f"  {title}")
+print(f"\nSkipped {len(ambiguousItems)} Plex items that match more than one AudiobookShelf item:")
+for title, libraryItemIds in ambiguousItems:
+    print(f"  {title}: {', '.join(f'{absItemTitles[libraryItemId]} ({libraryItemId})' for libraryItemId in sorted(libraryItemIds))}")
+
+print(f"\nFound {len(progressUpdates)} items to update progress for")
+for progressUpdate, status in absClient.progress_updater(progressBatchSize).write(progressUpdates):
+    if status != 200:
+        print(f"Error updating progress for {progressUpdate['libraryItemId']}: {status}")
 print("Progress updates sent to AudiobookShelf")
 print("Done")
\ No newline at end of file
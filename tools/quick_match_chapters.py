@@ -4,9 +4,10 @@
 # For example, if there are 123 chapters locally and 127 are found, chapters will be replaced.
 # However, if 120-126 chapters are found, they won’t be replaced.
 
-import time
-import requests
-from urllib import parse
+from abs_client import AbsClient, TokenBucket
+from lookup_cache import open_cache
+from run_metrics import write_metrics_at_exit
+from run_state import RunJournal, RunState, incremental_enabled, journal_options
 
 # Configuration constants
 CHAPTER_THRESHOLD = 3  # Threshold for determining missing chapters. Do disable overwriting existing chapters, set to 99999999 ;)
@@ -16,18 +17,37 @@ API_KEY = ""  # API Key from user settings
 PROVIDER = "audible.de"  # Metadata provider (See available providers in API documentation https://api.audiobookshelf.org/#metadata-providers)
 REGION = "DE"  # Region code (e.g., US, DE)
 DISABLE_RATE_PROTECTION = False  # Rate protection, disable to speed up but risk timeouts
+PROVIDER_REQUESTS_PER_SECOND = 2  # Rate protection: Lookups per second to the metadata provider, shared by all workers. This alone decides the speed (1 lookup per book with ASIN, 2 without, cached lookups are free).
+ABS_REQUESTS_PER_SECOND = 20  # Rate protection: Requests per second that are only handled by your server
+WORKERS = 4  # Number of books processed at the same time. Also the number of provider lookups that may be sent at once.
+CACHE_FILE = "lookup_cache.sqlite"  # Provider lookups are cached in this file, so re-runs skip them. Set to None to disable the cache.
+CACHE_TTL_DAYS = 30  # Cached lookups older than this are fetched again
+INCREMENTAL = False  # Only process items that are new, changed or failed since the last run. Can also be enabled with --incremental.
+STATE_FILE = "quick_match_chapters.state.json"  # Outcome of the last run, used by the incremental mode
+RESUME = False  # Continue the last run where it stopped, e.g. after a crash. Can also be enabled with --resume.
+RETRY_FAILED = False  # Only process the books that failed in the last run. Can also be enabled with --retry-failed.
+JOURNAL_FILE = "quick_match_chapters.journal.jsonl"  # Outcome of every book of the current run, used to resume or retry
 SEARCH_FOR_ASIN = True  # Search for ASIN if not available. Disable this to use tracks as chapters if no ASIN is available.
 USE_TRACKS_AS_CHAPTERS = False  # Use tracks as chapters if no asin available (Fallback)
+METRICS_FILE = "quick_match_chapters.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
 
 
 ############################################################################################################
 
 book_info = {}
 
+write_metrics_at_exit(METRICS_FILE, "quick_match_chapters")
+client = AbsClient(ABS_HOST, API_KEY, workers=WORKERS)
+
+# Every upstream gets its own limit, so fast calls to the server never wait for the slow provider
+provider_bucket = TokenBucket(None if DISABLE_RATE_PROTECTION else PROVIDER_REQUESTS_PER_SECOND, burst=WORKERS, name="provider rate limit")
+abs_bucket = TokenBucket(None if DISABLE_RATE_PROTECTION else ABS_REQUESTS_PER_SECOND, burst=WORKERS, name="server rate limit")
+lookup_cache = open_cache(CACHE_FILE, CACHE_TTL_DAYS)
+
 # Fetch all library items
-library_url = f"{ABS_HOST}/api/libraries/{LIBRARY_ID}/items?token={API_KEY}"
-print(f"Fetching library items from: {library_url}")
-response = requests.get(library_url)
+library_path = f"/api/libraries/{LIBRARY_ID}/items"
+print(f"Fetching library items from: {client.url(library_path)}")
+response = client.get(library_path)
 
 if response.status_code != 200:
     print("Error fetching library items:", response.status_code)
@@ -36,14 +56,30 @@ if response.status_code != 200:
 items = response.json().get('results', [])
 print(f"Found {len(items)} items in the library.")
 
-# Process each item in the library
-for item in items:
+run_state = RunState(STATE_FILE)
+if incremental_enabled(INCREMENTAL):
+    items = [item for item in items if run_state.needs_processing(item)]
+    print(f"Incremental mode: {len(items)} items are new, changed or failed in the last run.")
+
+run_items = items
+journal = RunJournal(JOURNAL_FILE, *journal_options(RESUME, RETRY_FAILED))
+if journal.resume or journal.retry_failed:
+    # Books that are not run again keep the outcome of the last run in the summary
+    for item in items:
+        entry = journal.entries.get(item['id'])
+        if entry is not None and not journal.should_process(item['id']):
+            book_info[item['id']] = { 'id': item['id'], 'title': item['media']['metadata'].get('title', "Unknown Title"), 'status': entry['status'], 'comment': entry['comment'], 'asin': 'N/A' }
+    items = journal.select(items)
+    print(f"Continuing the last run: {len(items)} items left to process.")
+
+
+# Processes a single book. Books are independent, so several of them run at the same time.
+def process_book(item):
     book_id = item['id']
     metadata = item['media']['metadata']
     title = metadata.get('title', "Unknown Title")
     subtitle = metadata.get('subtitle', "")
     authors = metadata.get('authorName', "Unknown Author")
-    book_info[book_id] = { 'id': book_id, 'title': title, 'status': 'ERROR', 'comment': 'Unknown Error', 'asin': 'N/A' }
 
     print(f"\n--- Processing Book: {title} ---")
 
@@ -53,25 +89,25 @@ for item in items:
         book_info[book_id]['asin'] = 'N/A'
 
         if SEARCH_FOR_ASIN:
-            match_url = f"{ABS_HOST}/api/search/books?title={parse.quote(title)}&author={parse.quote(authors)}&provider={PROVIDER}&token={API_KEY}"
-            new_item_response = requests.get(match_url)
+            search_params = {"title": title, "author": authors, "provider": PROVIDER}
+            search_status, search_results = lookup_cache.search(client, "books", PROVIDER, "", search_params, provider_bucket.acquire)
 
-            if new_item_response.status_code != 200:
-                print(f"Error matching book '{title}':", new_item_response.json())
-                continue
+            if search_status != 200:
+                print(f"Error matching book '{title}':", search_results)
+                return
 
-            if len(new_item_response.json()) == 0:
+            if len(search_results) == 0:
                 print(f"Error matching book '{title}' (No results found).")
                 book_info[book_id]['comment'] = 'Asin retrieval failed'
-                continue
+                return
 
-            best_match = new_item_response.json()[0]
+            best_match = search_results[0]
             asin = best_match.get('asin', None)
 
             if asin is None:
                 print(f"Error matching book '{title}' (No ASIN found).")
                 book_info[book_id]['comment'] = 'Asin retrieval failed - No ASIN found'
-                continue
+                return
 
             item['media']['metadata']['asin'] = asin
             metadata['asin'] = asin
@@ -81,12 +117,13 @@ for item in items:
     if 'asin' not in item['media']['metadata'] or item['media']['metadata']['asin'] is None:
         if USE_TRACKS_AS_CHAPTERS:
             # Get the tracks and use them as chapters
-            book_response = requests.get(f"{ABS_HOST}/api/items/{book_id}?expanded=1&token={API_KEY}")
+            abs_bucket.acquire()
+            book_response = client.get(f"/api/items/{book_id}", params={"expanded": 1})
             book_info[book_id]['status'] = 'TRACKS'
             if book_response.status_code != 200:
                 print(f"Error fetching book '{title}':", book_response.status_code)
                 book_info[book_id]['comment'] = 'Tracks retrieval failed'
-                continue
+                return
             if len(book_response.json()['media'].get('audioFiles', [])) > 1:
                 print(f"Using tracks as chapters for '{title}'.")
                 tracks = book_response.json()['media'].get('audioFiles', [])
@@ -103,7 +140,7 @@ for item in items:
                     print(f"Chapters are fine for '{title}'.")
                     book_info[book_id]['status'] = 'FINISHED'
                     book_info[book_id]['comment'] = 'No chapters to update'
-                    continue
+                    return
 
                 for i, track in enumerate(tracks):
                     duration = track['duration']
@@ -123,9 +160,9 @@ for item in items:
                         break
 
                 # Update chapters for the book
-                update_url = f"{ABS_HOST}/api/items/{book_id}/chapters?token={API_KEY}"
                 update_data = {"chapters": new_chapters}
-                update_response = requests.post(update_url, json=update_data)
+                abs_bucket.acquire()
+                update_response = client.post(f"/api/items/{book_id}/chapters", json=update_data)
 
                 if update_response.status_code == 200:
                     print(f"Chapters updated successfully for '{title}' (Using tracks!).")
@@ -135,32 +172,31 @@ for item in items:
                     print(f"Error updating chapters for '{title}'. Response Code:", update_response.status_code)
                     book_info[book_id]['comment'] = 'Chapters update failed'
 
-                continue
+                return
             else:
                 print(f"Error using tracks as chapters for '{title}' (No or 1 track found).")
                 book_info[book_id]['comment'] = 'Tracks retrieval failed'
         else:
             print(f"Skipping book '{title}' (No ASIN found and Tracks not used as source).")
             book_info[book_id]['comment'] = 'Asin retrieval failed'
-            continue
+            return
     else:
         book_info[book_id]['asin'] = item['media']['metadata']['asin']
 
     # Fetch chapters using ASIN
     asin = item['media']['metadata']['asin']
-    chapter_url = f"{ABS_HOST}/api/search/chapters?asin={asin}&region={REGION}&token={API_KEY}"
-    chapter_response = requests.get(chapter_url)
+    chapter_status, chapter_result = lookup_cache.search(client, "chapters", PROVIDER, REGION, {"asin": asin, "region": REGION}, provider_bucket.acquire)
 
-    if chapter_response.status_code != 200 or chapter_response.json().get('error') is not None:
+    if chapter_status != 200 or chapter_result.get('error') is not None:
         book_info[book_id]['comment'] = 'Chapters retrieval failed'
-        print(f"Error fetching chapters for '{title}'. Response Code:", chapter_response.status_code)
-        continue
+        print(f"Error fetching chapters for '{title}'. Response Code:", chapter_status)
+        return
 
-    chapters = chapter_response.json().get('chapters', [])
+    chapters = chapter_result.get('chapters', [])
     if len(chapters) == 0:
         book_info[book_id]['comment'] = 'No chapters found'
         print(f"No chapters found for '{title}'.")
-        continue
+        return
     print(f"Chapters found for '{title}': {len(chapters)}")
 
     # Compare current and found chapters
@@ -190,9 +226,9 @@ for item in items:
             })
 
         # Update chapters for the book
-        update_url = f"{ABS_HOST}/api/items/{book_id}/chapters?token={API_KEY}"
         update_data = {"chapters": new_chapters}
-        update_response = requests.post(update_url, json=update_data)
+        abs_bucket.acquire()
+        update_response = client.post(f"/api/items/{book_id}/chapters", json=update_data)
 
         if update_response.status_code == 200:
             print(f"Chapters updated successfully for '{title}'.")
@@ -206,9 +242,28 @@ for item in items:
         book_info[book_id]['comment'] = 'No chapters to update'
         print(f"Chapters are fine for '{title}'.")
 
-    # Respect rate-limiting if enabled
-    if not DISABLE_RATE_PROTECTION:
-        time.sleep(2)
+
+def run_book(item):
+    try:
+        process_book(item)
+    except Exception as e:
+        print(f"Error processing book '{item['media']['metadata'].get('title', item['id'])}': {e}")
+        book_info[item['id']]['comment'] = f'Unexpected error: {e}'
+    journal.record(item['id'], book_info[item['id']]['status'], book_info[item['id']]['comment'])
+
+
+# Register all books up front, so the summary keeps the library order
+for item in items:
+    book_info[item['id']] = { 'id': item['id'], 'title': item['media']['metadata'].get('title', "Unknown Title"), 'status': 'ERROR', 'comment': 'Unknown Error', 'asin': 'N/A' }
+
+for _ in client.map(run_book, items):
+    pass
+journal.close()
+
+for item in run_items:
+    if item['id'] in book_info:
+        run_state.record(item, book_info[item['id']]['status'], book_info[item['id']]['comment'])
+run_state.save()
 
 print("\n--- Summary ---")
 for book_id, info in book_info.items():
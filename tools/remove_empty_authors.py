@@ -1,50 +1,65 @@
 # This scripts deletes all authors that have no books associated with them.
-import requests
+from abs_client import AbsClient, TokenBucket
+from run_metrics import write_metrics_at_exit
 
 # Configuration constants
 ABS_HOST = ""  # AudiobookShelf Host URL
 LIBRARY_ID = None  # Leave None to process all libraries you have
 API_KEY = ""  # API Key from user settings
 DELETE_WITHOUT_CONFIRMATION = False  # Set to True to delete authors without confirmation
+WORKERS = 8  # Number of authors deleted at the same time
+DELETES_PER_SECOND = 20  # Rate protection: Authors deleted per second. Set to None to disable the limit.
+METRICS_FILE = "remove_empty_authors.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
 
 
+write_metrics_at_exit(METRICS_FILE, "remove_empty_authors")
+client = AbsClient(ABS_HOST, API_KEY, workers=WORKERS)
+author_deleter = client.author_deleter(before_request=TokenBucket(DELETES_PER_SECOND, burst=WORKERS, name="delete rate limit").acquire)
+
 library_ids = []
 if LIBRARY_ID is None:
-    all_libraries_response = requests.get(f"{ABS_HOST}/api/libraries?token={API_KEY}")
-    for library in all_libraries_response.json()['libraries']:
+    for library in client.get_libraries():
         library_ids.append(library['id'])
 else:
     library_ids.append(LIBRARY_ID)
 
 print(f"Processing {len(library_ids)} libraries")
 
+# Collect the authors without books of all libraries first. Every author is only listed and deleted once,
+# even if more than one library returns it.
+author_names = {}
 for library_id in library_ids:
     print(f"Processing library {library_id}")
-    authors_response = requests.get(f"{ABS_HOST}/api/libraries/{library_id}/authors?token={API_KEY}")
-    authors_to_delete = []
-    for author in authors_response.json()['authors']:
-        author_id = author['id']
-        author_name = author['name']
-        author_num_books = author['numBooks']
-        if author_num_books == 0:
-            authors_to_delete.append((author_id, author_name, author_num_books))
-    print(f"\n\nFound {len(authors_to_delete)} authors without books")
-    print("The following authors will be deleted:")
-    for author in authors_to_delete:
-        print(f"{author[1]} ({author[2]} books) - ID: {author[0]}")
-    if not DELETE_WITHOUT_CONFIRMATION:
-        user_input = input("Do you want to delete these authors? (y/n): ")
-        if user_input.lower() != "y":
-            print("Skipping deletion")
-            continue
-    print("\n\n----------------------\n\n")
-    for author in authors_to_delete:
-        author_id = author[0]
-        delete_response = requests.delete(f"{ABS_HOST}/api/authors/{author_id}?token={API_KEY}")
-        if delete_response.status_code == 200:
-            print(f"Deleted author {author[1]}")
-        else:
-            print(f"Error deleting author {author[1]}: {delete_response.status_code}")
-    print("\n\n----------------------\n\n")
-
-print("Done")
\ No newline at end of file
+    found = 0
+    for author in client.iter_library_authors(library_id):
+        if author['numBooks'] == 0 and author['id'] not in author_names:
+            author_names[author['id']] = author['name']
+            found += 1
+    print(f"Found {found} authors without books")
+
+print(f"\n\nFound {len(author_names)} authors without books")
+if len(author_names) == 0:
+    print("Done")
+    exit()
+
+print("The following authors will be deleted:")
+for author_id, author_name in author_names.items():
+    print(f"{author_name} (0 books) - ID: {author_id}")
+if not DELETE_WITHOUT_CONFIRMATION:
+    user_input = input("Do you want to delete these authors? (y/n): ")
+    if user_input.lower() != "y":
+        print("Skipping deletion")
+        exit()
+
+print("\n\n----------------------\n\n")
+deleted = 0
+for author_id, status in author_deleter.write(author_names):
+    if status == 200:
+        deleted += 1
+        print(f"Deleted author {author_names[author_id]}")
+    else:
+        print(f"Error deleting author {author_names[author_id]}: {status}")
+print("\n\n----------------------\n\n")
+
+print(f"Deleted {deleted} of {len(author_names)} authors")
+print("Done")
@@ -0,0 +1,202 @@
+# Records where a run of a script spent its time: every HTTP request (count, status codes, bytes, latency histogram and
+# retries per endpoint), the time spent waiting for rate limits, named phases (e.g. the SQLite steps of a migration)
+# and simple counters like cache hits.
+# At the end of the run everything is written as JSON and as a Prometheus textfile (for the textfile collector of
+# node_exporter), so a slow run can be traced to the server, the metadata provider or local processing.
+# All scripts share the module level `metrics`, the HTTP client in abs_client.py records into it automatically.
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Upper bounds in seconds
+PREFIX = "abs_toolbox"
+
+# Path segments with a digit are ids (UUIDs, numeric Plex keys, ...) and are grouped into one endpoint
+ID_SEGMENT = re.compile(r"\d")
+
+
+# Turns a request path into the endpoint it is counted under, e.g. /api/items/<id>/media -> /api/items/{id}/media
+def endpoint_name(path):
+    path = path.split("?", 1)[0]
+    return "/".join("{id}" if ID_SEGMENT.search(segment) else segment for segment in path.split("/"))
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.requests = {}  # (method, endpoint) -> stats
+        self.waits = {}  # reason -> seconds
+        self.phases = {}  # phase name -> seconds, in the order the phases first ran
+        self.counters = {}  # name -> value
+
+    # status is None if the request raised (connection error, timeout, ...)
+    def record_request(self, method, path, status, seconds, bytes_sent=0, bytes_received=0, retries=0):
+        key = (method, endpoint_name(path))
+        with self.lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = self.requests[key] = {
+                    "count": 0, "statuses": {}, "retries": 0, "bytesSent": 0, "bytesReceived": 0,
+                    "seconds": 0.0, "maxSeconds": 0.0, "buckets": [0] * len(LATENCY_BUCKETS),
+                }
+            status = "error" if status is None else str(status)
+            stats["count"] += 1
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+            stats["retries"] += retries
+            stats["bytesSent"] += bytes_sent
+            stats["bytesReceived"] += bytes_received
+            stats["seconds"] += seconds
+            stats["maxSeconds"] = max(stats["maxSeconds"], seconds)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][index] += 1
+                    break
+
+    def record_wait(self, reason, seconds):
+        with self.lock:
+            self.waits[reason] = self.waits.get(reason, 0.0) + seconds
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Measures the time spent in the block, waiting for a limiter or the like
+    @contextmanager
+    def waiting(self, reason):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_wait(reason, time.perf_counter() - started)
+
+    # Measures the time spent in the block as a phase of the run. A phase that runs more than once is summed up.
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def report(self, tool):
+        with self.lock:
+            duration = time.perf_counter() - self.started
+            requests = {}
+            for (method, endpoint), stats in sorted(self.requests.items()):
+                cumulative = 0
+                histogram = {}
+                for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+                    cumulative += count
+                    histogram[str(bound)] = cumulative
+                histogram["+Inf"] = stats["count"]
+                requests[f"{method} {endpoint}"] = {
+                    "method": method,
+                    "endpoint": endpoint,
+                    **{key: value for key, value in stats.items() if key != "buckets"},
+                    "latencyHistogram": histogram,
+                }
+            return {
+                "tool": tool,
+                "startedAt": self.started_at,
+                "durationSeconds": duration,
+                "requestCount": sum(stats["count"] for stats in self.requests.values()),
+                "requestSeconds": sum(stats["seconds"] for stats in self.requests.values()),
+                "requests": requests,
+                "waits": dict(self.waits),
+                "phases": dict(self.phases),
+                "counters": dict(self.counters),
+            }
+
+    # Writes <path>.json and <path>.prom. Both files are replaced at once, so a collector never reads half a file.
+    def write(self, path, tool):
+        report = self.report(tool)
+        write_atomic(f"{path}.json", json.dumps(report, indent=2))
+        write_atomic(f"{path}.prom", prometheus_text(report))
+        return report
+
+
+def write_atomic(path, text):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def labels(**values):
+    return "{" + ",".join(f'{name}="{label_value(value)}"' for name, value in values.items()) + "}"
+
+
+def prometheus_text(report):
+    tool = report["tool"]
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+        for suffix, sample_labels, value in samples:
+            lines.append(f"{PREFIX}_{name}{suffix}{labels(tool=tool, **sample_labels)} {value}")
+
+    requests = report["requests"].values()
+    metric("http_requests_total", "counter", "HTTP requests by endpoint and status code (error if the request raised)", [
+        ("", {"method": stats["method"], "endpoint": stats["endpoint"], "status": status}, count)
+        for stats in requests for status, count in sorted(stats["statuses"].items())
+    ])
+    metric("http_retries_total", "counter", "Retries of HTTP requests by endpoint", [
+        ("", {"method": stats["method"], "endpoint": stats["endpoint"]}, stats["retries"]) for stats in requests
+    ])
+    metric("http_sent_bytes_total", "counter", "Bytes sent in request bodies by endpoint", [
+        ("", {"method": stats["method"], "endpoint": stats["endpoint"]}, stats["bytesSent"]) for stats in requests
+    ])
+    metric("http_received_bytes_total", "counter", "Bytes received in response bodies by endpoint", [
+        ("", {"method": stats["method"], "endpoint": stats["endpoint"]}, stats["bytesReceived"]) for stats in requests
+    ])
+    histogram = []
+    for stats in requests:
+        endpoint = {"method": stats["method"], "endpoint": stats["endpoint"]}
+        histogram += [("_bucket", {**endpoint, "le": bound}, count) for bound, count in stats["latencyHistogram"].items()]
+        histogram += [("_sum", endpoint, stats["seconds"]), ("_count", endpoint, stats["count"])]
+    metric("http_request_duration_seconds", "histogram", "Latency of HTTP requests by endpoint, including retries", histogram)
+    metric("wait_seconds_total", "counter", "Time spent waiting for rate and concurrency limits", [
+        ("", {"reason": reason}, seconds) for reason, seconds in report["waits"].items()
+    ])
+    metric("phase_duration_seconds", "gauge", "Duration of the phases of the run", [
+        ("", {"phase": phase}, seconds) for phase, seconds in report["phases"].items()
+    ])
+    metric("events_total", "counter", "Counted events of the run, e.g. cache hits", [
+        ("", {"name": name}, value) for name, value in report["counters"].items()
+    ])
+    metric("run_duration_seconds", "gauge", "Duration of the run", [("", {}, report["durationSeconds"])])
+    metric("run_finished_timestamp_seconds", "gauge", "Unix time the run finished", [("", {}, time.time())])
+    return "\n".join(lines) + "\n"
+
+
+metrics = RunMetrics()
+
+
+# Writes the metrics of the run to <path>.json and <path>.prom when the script ends, also if it ends early with exit()
+# or an error. Does nothing if path is None.
+def write_metrics_at_exit(path, tool):
+    if path is None:
+        return
+
+    def write():
+        report = metrics.write(path, tool)
+        summary = f"{report['durationSeconds']:.1f}s in total"
+        if report['requestCount'] > 0:
+            summary = (f"{report['requestCount']} requests taking {report['requestSeconds']:.1f}s and "
+                       f"{sum(report['waits'].values()):.1f}s waiting for limits (summed over all workers), {summary}")
+        print(f"\nMetrics written to {path}.json and {path}.prom: {summary}")
+
+    atexit.register(write)
@@ -0,0 +1,117 @@
+# Remembers which library items a script processed in its last run, so an incremental run only touches
+# items that are new, changed on the server or failed last time.
+# An item counts as changed when its updatedAt (or, if missing, the hash of its media) differs from the recorded one.
+# Items the script itself updated therefore get checked once more on the following run.
+#
+# While a run is going, the outcome of every item is also appended to a journal, so a run that crashed or was
+# stopped can be resumed where it stopped (--resume), or only the failed items can be run again (--retry-failed).
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+# True if incremental mode is enabled in the script configuration or with --incremental on the command line
+def incremental_enabled(configured):
+    return configured or "--incremental" in sys.argv[1:]
+
+
+def item_fingerprint(item):
+    if item.get('updatedAt') is not None:
+        return str(item['updatedAt'])
+    media = json.dumps(item.get('media'), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(media.encode('utf-8')).hexdigest()
+
+
+class RunState:
+    def __init__(self, path, success_status='FINISHED'):
+        self.path = path
+        self.success_status = success_status
+        self.lock = threading.Lock()
+        self.items = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.items = json.load(f).get('items', {})
+
+    # True if the item is new, changed since the last run or was not processed successfully
+    def needs_processing(self, item):
+        recorded = self.items.get(item['id'])
+        return recorded is None or recorded['status'] != self.success_status or recorded['fingerprint'] != item_fingerprint(item)
+
+    def record(self, item, status, comment=None):
+        with self.lock:
+            self.items[item['id']] = {'fingerprint': item_fingerprint(item), 'status': status, 'comment': comment}
+
+    # Writes to a temporary file first, so an interrupted save never destroys the previous state
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with self.lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'items': self.items}, f)
+        os.replace(tmp_path, self.path)
+
+
+# Returns (resume, retry_failed) from the script configuration and the --resume/--retry-failed command line options
+def journal_options(resume, retry_failed):
+    return resume or "--resume" in sys.argv[1:], retry_failed or "--retry-failed" in sys.argv[1:]
+
+
+# Append-only file with one JSON line per finished item. Lines are flushed right away, but only synced to disk every
+# `sync_every` items or `sync_interval` seconds, so the journal costs almost nothing even for fast scripts.
+# A new run starts a new journal. When resuming or retrying, the previous journal is read and continued.
+class RunJournal:
+    def __init__(self, path, resume=False, retry_failed=False, success_status='FINISHED', sync_every=50, sync_interval=2.0):
+        self.resume = resume
+        self.retry_failed = retry_failed
+        self.success_status = success_status
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        continue_journal = resume or retry_failed
+        if continue_journal and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # The last line is incomplete if the previous run was killed while writing it
+                    self.entries[entry['key']] = entry
+        self.file = open(path, 'a' if continue_journal else 'w', encoding='utf-8')
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    # True if the item with this key has to be processed in this run.
+    # Resuming skips everything that already has an outcome, retrying only takes the items that failed.
+    def should_process(self, key):
+        entry = self.entries.get(key)
+        if not self.resume and not self.retry_failed:
+            return True
+        if entry is None:
+            return self.resume
+        return self.retry_failed and entry['status'] != self.success_status
+
+    def select(self, items, key=lambda item: item['id']):
+        return [item for item in items if self.should_process(key(item))]
+
+    def record(self, key, status, comment=None):
+        entry = {'key': key, 'status': status, 'comment': comment}
+        with self.lock:
+            self.entries[key] = entry
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
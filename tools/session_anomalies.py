@@ -0,0 +1,147 @@
+# This script scans all listening sessions for sessions that can not be right and ranks them by how much listening
+# time they add that most likely never happened. It finds:
+# - duplicates: the same session (user, book, positions and listening time) saved more than once within a minute
+# - overlaps: sessions of a user that started while another session of the same user was still running
+# - sessions with more listening time than time passed between their start and their last update (wall clock)
+# - sessions with much more listening time than the distance between their start and end position
+# All checks work on NumPy arrays of all sessions at once, so the whole server is scanned in one pass.
+# cleanup_listening_sessions.py and correct_listening_sessions.py can use the results directly (USE_ANOMALY_SCANNER).
+# Needs NumPy: pip install numpy
+import json
+
+import numpy as np
+
+from abs_client import AbsClient
+from listening_stats import SessionColumns
+from run_metrics import metrics, write_metrics_at_exit
+from session_store import SessionStore
+
+# Configuration constants
+ABS_HOST = ""  # AudiobookShelf Host URL
+API_KEY = ""  # API Key of an admin user
+USER_IDS = []  # Users whose sessions are scanned. Keep empty to process all users.
+WALL_CLOCK_TOLERANCE = 300  # Seconds a session may listen longer than the time between its start and last update
+POSITION_RATIO = 2  # A session is flagged if it listened more than this times the distance between start and end position
+MIN_EXCESS = 60  # Seconds of unlikely listening time below which a session is not reported
+DUPLICATE_WINDOW = 60  # Seconds between the starts of two otherwise identical sessions to count them as duplicates
+SESSIONS_PER_PAGE = 500  # Number of sessions fetched per request while syncing
+SESSION_STORE_FILE = "sessions.sqlite"  # Sessions are kept in this file, so later runs only download new and changed ones
+OUTPUT_FILE = "session_anomalies.json"  # The ranked list of flagged sessions is written to this file. Set to None to disable.
+METRICS_FILE = "session_anomalies.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
+
+USER_OFFSET = 10 ** 13  # Larger than any timestamp in ms, keeps the running maximum of the overlap check within one user
+
+
+# Marks every session that has the same user, book, positions and listening time as the session before it
+# and started at most `window` seconds after it
+def find_duplicates(columns, window=DUPLICATE_WINDOW):
+    order = np.lexsort((columns.started_at, columns.time_listening, columns.current_time, columns.start_time, columns.item, columns.user))
+    started_at = columns.started_at[order]
+    same_as_previous = started_at[1:] - started_at[:-1] <= window * 1000
+    for column in (columns.user, columns.item, columns.start_time, columns.current_time, columns.time_listening):
+        sorted_column = column[order]
+        same_as_previous &= sorted_column[1:] == sorted_column[:-1]
+    duplicate = np.zeros(len(columns), dtype=bool)
+    duplicate[order[1:][same_as_previous]] = True
+    return duplicate
+
+
+# The time every session ended in ms: its start plus its listening time, but not after its last update.
+# The last update alone is not the end, a session synced days later from a phone or re-created through
+# /api/session/local gets a much later updatedAt than the time it was played.
+def session_ends(columns):
+    duration_ms = (columns.time_listening * 1000).astype(np.int64)
+    wall_clock_ms = np.where(columns.updated_at > 0, np.clip(columns.updated_at - columns.started_at, 0, None), duration_ms)
+    return columns.started_at + np.minimum(duration_ms, wall_clock_ms)
+
+
+# Seconds every session started before another session of the same user had ended (0 if it did not overlap).
+# Sessions are sorted by user and start.
+def find_overlaps(columns, ignore):
+    order = np.lexsort((columns.started_at, columns.user))
+    order = order[~ignore[order]]
+    user = columns.user[order].astype(np.int64)
+    ends = session_ends(columns)[order]
+    # Running maximum of the ends within every user, the offset per user keeps earlier users from counting
+    latest_end = np.maximum.accumulate(ends + user * USER_OFFSET) - user * USER_OFFSET
+    overlap_ms = np.zeros(len(order), dtype=np.int64)
+    if len(order) > 1:
+        same_user = user[1:] == user[:-1]
+        overlap_ms[1:] = np.where(same_user, np.minimum(latest_end[:-1], ends[1:]) - columns.started_at[order][1:], 0)
+    overlaps = np.zeros(len(columns), dtype=np.float64)
+    overlaps[order] = np.clip(overlap_ms, 0, None) / 1000
+    return overlaps
+
+
+# Returns the flagged sessions, ranked by the listening time that is most likely wrong (largest first).
+# action is "delete" for duplicates, otherwise "correct" with the suggested listening time. Overlapping sessions are
+# never deleted, the overlap may also come from wrong timestamps of the other session.
+def scan(sessions, wall_clock_tolerance=WALL_CLOCK_TOLERANCE, position_ratio=POSITION_RATIO, min_excess=MIN_EXCESS, duplicate_window=DUPLICATE_WINDOW):
+    columns = SessionColumns(sessions)
+    time_listening = columns.time_listening
+    wall_clock = np.clip(columns.updated_at - columns.started_at, 0, None) / 1000
+    position_span = np.abs(columns.current_time - columns.start_time)
+
+    duplicate = find_duplicates(columns, duplicate_window)
+    overlap = find_overlaps(columns, duplicate)
+    has_wall_clock = columns.updated_at > 0
+    wall_clock_excess = np.where(has_wall_clock & (time_listening > wall_clock + wall_clock_tolerance), time_listening - wall_clock, 0)
+    position_excess = np.where(time_listening > position_ratio * position_span, time_listening - position_span, 0)
+
+    suggested = time_listening - overlap
+    suggested = np.where(wall_clock_excess > 0, np.minimum(suggested, wall_clock), suggested)
+    suggested = np.where(position_excess > 0, np.minimum(suggested, position_span), suggested)
+    suggested = np.clip(suggested, 0, None)
+    excess = np.where(duplicate, time_listening, time_listening - suggested)
+
+    flagged = np.flatnonzero(duplicate | (excess >= min_excess))
+    flagged = flagged[np.argsort(-excess[flagged], kind="stable")]
+
+    candidates = []
+    for index in flagged:
+        reasons = [reason for reason, hit in (
+            ("duplicate", duplicate[index]),
+            ("overlap", overlap[index] > 0),
+            ("wall_clock", wall_clock_excess[index] > 0),
+            ("position", position_excess[index] > 0),
+        ) if hit]
+        delete = bool(duplicate[index])
+        candidates.append({
+            "id": columns.ids[index],
+            "userId": columns.user_ids[columns.user[index]],
+            "title": columns.item_titles[columns.item[index]],
+            "reasons": reasons,
+            "excess": float(excess[index]),
+            "timeListening": float(time_listening[index]),
+            "action": "delete" if delete else "correct",
+            "suggestedTimeListening": None if delete else float(suggested[index]),
+        })
+    return candidates
+
+
+if __name__ == "__main__":
+    write_metrics_at_exit(METRICS_FILE, "session_anomalies")
+    client = AbsClient(ABS_HOST, API_KEY)
+    if len(USER_IDS) == 0:
+        USER_IDS = [user['id'] for user in client.get_users()]
+
+    session_store = SessionStore(SESSION_STORE_FILE)
+    with metrics.phase("sync sessions"):
+        session_store.sync(client, USER_IDS, SESSIONS_PER_PAGE)
+    with metrics.phase("read session store"):
+        sessions = [session for user_id in USER_IDS for session in session_store.sessions(user_id=user_id)]
+    session_store.close()
+
+    with metrics.phase("scan"):
+        candidates = scan(sessions)
+    for rank, candidate in enumerate(candidates, start=1):
+        suggestion = "delete" if candidate['action'] == "delete" else f"set to {candidate['suggestedTimeListening'] / 3600:.2f} h"
+        print(f"{rank}. {candidate['title']} ({candidate['userId']}, {candidate['id']}): {candidate['timeListening'] / 3600:.2f} h, "
+              f"{candidate['excess'] / 3600:.2f} h unlikely [{', '.join(candidate['reasons'])}] -> {suggestion}")
+    print(f"\nFlagged {len(candidates)} of {len(sessions)} sessions "
+          f"({sum(candidate['action'] == 'delete' for candidate in candidates)} to delete, "
+          f"{sum(candidate['action'] == 'correct' for candidate in candidates)} to correct)")
+
+    if OUTPUT_FILE is not None:
+        with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+            json.dump(candidates, f, indent=2)
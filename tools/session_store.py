@@ -0,0 +1,130 @@
+# Local copy of the listening sessions of the server in a SQLite file.
+# A sync only downloads the sessions that are new or changed since the last one: the server returns the sessions of a
+# user ordered by updatedAt (newest first), so the sync stops at the first page that contains only known sessions.
+# If the number of sessions of a user still differs from the server afterwards (e.g. sessions were deleted on the
+# server), all sessions of the user are walked once more and the ones the server no longer has are removed.
+# Limitation: if sessions were deleted and the same number of sessions was added between two syncs, the counts match
+# and the deleted sessions stay in the store until the counts differ again. Scripts that delete sessions therefore
+# treat a 404 for a stored session as already deleted.
+# Sessions are read and written page by page, so memory use does not grow with the length of the history.
+import json
+import sqlite3
+
+from abs_client import chunked
+
+DEFAULT_STORE_FILE = "sessions.sqlite"
+
+
+class SessionStore:
+    def __init__(self, path=DEFAULT_STORE_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                userId TEXT NOT NULL,
+                libraryItemId TEXT,
+                timeListening REAL,
+                startTime REAL,
+                currentTime REAL,
+                date TEXT,
+                updatedAt INTEGER,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_user ON sessions (userId, updatedAt);
+            CREATE INDEX IF NOT EXISTS sessions_item ON sessions (libraryItemId);
+            CREATE INDEX IF NOT EXISTS sessions_time_listening ON sessions (timeListening);
+            CREATE INDEX IF NOT EXISTS sessions_date ON sessions (date);
+        """)
+
+    def put(self, sessions):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sessions (id, userId, libraryItemId, timeListening, startTime, currentTime, date, updatedAt, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(session['id'], session['userId'], session.get('libraryItemId'), session.get('timeListening'), session.get('startTime'),
+                  session.get('currentTime'), session.get('date'), session.get('updatedAt'), json.dumps(session)) for session in sessions],
+            )
+
+    def remove(self, session_ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM sessions WHERE id = ?", [(session_id,) for session_id in session_ids])
+
+    # Returns the updatedAt of the given sessions that are stored, by id
+    def known_versions(self, session_ids):
+        known = {}
+        session_ids = list(session_ids)
+        for start in range(0, len(session_ids), 500):
+            chunk = session_ids[start:start + 500]
+            rows = self.conn.execute(f"SELECT id, updatedAt FROM sessions WHERE id IN ({', '.join('?' for _ in chunk)})", chunk)
+            known.update(rows)
+        return known
+
+    def count(self, user_id):
+        return self.conn.execute("SELECT count(*) FROM sessions WHERE userId = ?", (user_id,)).fetchone()[0]
+
+    # Downloads the new and changed sessions of a user. Returns the number of sessions that were stored or removed.
+    def sync_user(self, client, user_id, per_page=500):
+        path = f"/api/users/{user_id}/listening-sessions"
+        server_total = client.get_json(path, params={"itemsPerPage": 1, "page": 0})['total']
+
+        stored = 0
+        page = []
+        server_sessions = client.iter_listening_sessions(user_id, per_page)
+        for session in server_sessions:
+            page.append(session)
+            if len(page) < per_page:
+                continue
+            changed = self.changed_sessions(page)
+            self.put(changed)
+            stored += len(changed)
+            page = []
+            if len(changed) == 0:
+                break
+        else:
+            changed = self.changed_sessions(page)
+            self.put(changed)
+            stored += len(changed)
+        server_sessions.close()
+
+        removed = 0
+        if self.count(user_id) != server_total:
+            # Only the ids are kept in memory, the sessions themselves are stored page by page
+            server_ids = set()
+            for page in chunked(client.iter_listening_sessions(user_id, per_page), per_page):
+                server_ids.update(session['id'] for session in page)
+                self.put(page)
+            stale_ids = [row[0] for row in self.conn.execute("SELECT id FROM sessions WHERE userId = ?", (user_id,)) if row[0] not in server_ids]
+            self.remove(stale_ids)
+            removed = len(stale_ids)
+        return stored, removed
+
+    def changed_sessions(self, sessions):
+        known = self.known_versions(session['id'] for session in sessions)
+        return [session for session in sessions if session['id'] not in known or known[session['id']] != session.get('updatedAt')]
+
+    def sync(self, client, user_ids, per_page=500):
+        for user_id in user_ids:
+            stored, removed = self.sync_user(client, user_id, per_page)
+            print(f"Synced sessions of user {user_id}: {stored} new or changed, {removed} removed, {self.count(user_id)} in total")
+
+    # Yields the stored sessions matching all given filters, one at a time. longer_than/shorter_than are listening times
+    # in seconds, since/until are dates like "2024-01-31" (inclusive).
+    def sessions(self, user_id=None, library_item_id=None, longer_than=None, shorter_than=None, since=None, until=None):
+        filters = [
+            ("userId = ?", user_id),
+            ("libraryItemId = ?", library_item_id),
+            ("timeListening > ?", longer_than),
+            ("timeListening < ?", shorter_than),
+            ("date >= ?", since),
+            ("date <= ?", until),
+        ]
+        conditions = [condition for condition, value in filters if value is not None]
+        params = [value for _, value in filters if value is not None]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        for row in self.conn.execute(f"SELECT data FROM sessions {where} ORDER BY updatedAt DESC", params):
+            yield json.loads(row[0])
+
+    def close(self):
+        self.conn.close()
+
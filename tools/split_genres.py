@@ -1,7 +1,10 @@
 # This script splits genres that contain ", " into multiple genres so you can more easily search for a single tag.
 import base64
+import sys
 
-import requests
+from abs_client import AbsClient, MediaDeltaWriter
+from run_metrics import write_metrics_at_exit
+from run_state import RunJournal, RunState, incremental_enabled, journal_options
 
 # Configuration constants
 
@@ -11,17 +14,24 @@ ABS_HOST = ""  # AudiobookShelf Host URL
 API_KEY = ""
 LIBRARY_IDS = []  # Leave empty to process all libraries
 SKIP_GENRES = ['Mystery, Thriller & Suspense']  # Genres to skip
+BATCH_SIZE = 100  # Number of books updated per request. Older servers without the batch endpoint update them one by one.
+INCREMENTAL = False  # Only process books that are new, changed or failed since the last run. Can also be enabled with --incremental.
+STATE_FILE = "split_genres.state.json"  # Outcome of the last run, used by the incremental mode
+SINGLE_PASS = False  # Read every library once and update every book once with all its genres split. Can also be enabled with --single-pass.
+ITEMS_PER_PAGE = 500  # Books fetched per request in single pass mode
+RESUME = False  # Continue the last run where it stopped, e.g. after a crash. Can also be enabled with --resume.
+RETRY_FAILED = False  # Only process the books that failed in the last run. Can also be enabled with --retry-failed.
+JOURNAL_FILE = "split_genres.journal.jsonl"  # Outcome of every book of the current run, used to resume or retry
+METRICS_FILE = "split_genres.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
 
 
 ###### Code ######
 
+client = AbsClient(ABS_HOST, API_KEY)
+
+
 def get_all_genres():
-    response = requests.get(
-        f"{ABS_HOST}/api/genres",
-        params={"token": API_KEY}
-    )
-    response.raise_for_status()
-    return response.json()['genres']
+    return client.get_json("/api/genres")['genres']
 
 
 # Returns all genres that include ", "
@@ -38,19 +48,18 @@ def get_all_books_for_genre(genre: str, id):
     base64_genre = genre.encode('utf-8')
     url_encoded_genre = base64.urlsafe_b64encode(base64_genre).decode('utf-8')
 
-    response = requests.get(
-        f"{ABS_HOST}/api/libraries/{id}/items",
+    response = client.get_json(
+        f"/api/libraries/{id}/items",
         params={
             "limit": 99999,
-            "filter": f"genres.{url_encoded_genre}",
-            "token": API_KEY
+            "filter": f"genres.{url_encoded_genre}"
         }
     )
-    response.raise_for_status()
-    return response.json()['results']
+    return response['results']
 
 
-def append_genre_to_book(book, genre):
+# Returns the (book, media_payload) update that replaces the multi genre with its single genres
+def split_genre_of_book(book, genre):
     genres = genre.split(", ")
     book_genres = book['media']['metadata']['genres']
 
@@ -59,28 +68,53 @@ def append_genre_to_book(book, genre):
     # Remove the genre from the book
     book_genres.remove(genre)
 
-    book_id = book['id']
-
     patch_body = {"metadata": {"genres": book_genres}}
 
-    response = requests.patch(
-        f"{ABS_HOST}/api/items/{book_id}/media",
-        params={"token": API_KEY},
-        json=patch_body
-    )
-    response.raise_for_status()
+    return book, patch_body
+
+
+# Returns the genres of the book with every multi genre replaced by its single genres, keeping the order
+def split_genres_of_book(book_genres):
+    split_genres = []
+    for genre in book_genres:
+        parts = genre.split(", ") if ", " in genre and genre not in SKIP_GENRES else [genre]
+        for part in parts:
+            if part not in split_genres:
+                split_genres.append(part)
+    return split_genres
 
 
 def get_all_libraries():
-    response = requests.get(
-        f"{ABS_HOST}/api/libraries",
-        params={"token": API_KEY}
-    )
-    response.raise_for_status()
-    return response.json()['libraries']
+    return client.get_libraries()
+
+
+# Streams every library once and sends one update per book that has at least one multi genre
+def run_single_pass(delta_writer, run_state, incremental, journal):
+    for library_id in LIBRARY_IDS:
+        print(f"Processing library {library_id}", end="\n\n")
+
+        def updates():
+            for book in client.iter_library_items(library_id, ITEMS_PER_PAGE):
+                if (not incremental or run_state.needs_processing(book)) and journal.should_process(book['id']):
+                    yield book, {"metadata": {"genres": split_genres_of_book(book['media']['metadata'].get('genres') or [])}}
+
+        book_titles = []
+        for book, status in delta_writer.write(updates()):
+            if status is None:
+                run_state.record(book, 'FINISHED')
+                journal.record(book['id'], 'FINISHED')
+                continue
+            if status != 200:
+                print(f"Error processing book {book['id']}: {status}")
+            book_titles.append(book['media']['metadata']['title'])
+            run_state.record(book, 'FINISHED' if status == 200 else 'ERROR', 'Genres split')
+            journal.record(book['id'], 'FINISHED' if status == 200 else 'ERROR', 'Genres split')
+        print(f"Processed {len(book_titles)} books in library {library_id}: {book_titles}", end="\n\n")
+        print("----------------------", end="\n")
 
 
 if __name__ == "__main__":
+    write_metrics_at_exit(METRICS_FILE, "split_genres")
 
     if len(LIBRARY_IDS) == 0:
         libraries = get_all_libraries()
@@ -90,19 +124,39 @@ if __name__ == "__main__":
     print(f"Processing {len(LIBRARY_IDS)} libraries")
     print(LIBRARY_IDS)
     print("----------------------")
-    multi_genres = get_multi_genres(get_all_genres())
+    delta_writer = MediaDeltaWriter(client.media_updater(BATCH_SIZE))
+    run_state = RunState(STATE_FILE)
+    incremental = incremental_enabled(INCREMENTAL)
+    journal = RunJournal(JOURNAL_FILE, *journal_options(RESUME, RETRY_FAILED))
+
+    if SINGLE_PASS or "--single-pass" in sys.argv[1:]:
+        run_single_pass(delta_writer, run_state, incremental, journal)
+        journal.close()
+        run_state.save()
+        print(f"Books: {delta_writer.summary()}")
+        exit()
 
+    multi_genres = get_multi_genres(get_all_genres())
     for genre in multi_genres:
         print(f"Processing genre {genre}", end="\n\n")
         book_titles_overall = []
         for library_id in LIBRARY_IDS:
             books = get_all_books_for_genre(genre, library_id)
+            if incremental:
+                books = [book for book in books if run_state.needs_processing(book)]
+            # A book with several multi genres is updated once per genre, so the journal keys include the genre
+            books = journal.select(books, key=lambda book: f"{genre}:{book['id']}")
             book_titles = [book['media']['metadata']['title'] for book in books]
             book_titles_overall += book_titles
-            for book in books:
-                try:
-                    append_genre_to_book(book, genre)
-                except Exception as e:
-                    print(f"Error processing book {book['id']}: {e}")
+            updates = [split_genre_of_book(book, genre) for book in books]
+            for book, status in delta_writer.write(updates):
+                if status is not None and status != 200:
+                    print(f"Error processing book {book['id']}: {status}")
+                run_state.record(book, 'FINISHED' if status in (None, 200) else 'ERROR', genre)
+                journal.record(f"{genre}:{book['id']}", 'FINISHED' if status in (None, 200) else 'ERROR', genre)
         print(f"Processed {len(book_titles_overall)} books for genre {genre}: {book_titles_overall}", end="\n\n")
         print("----------------------", end="\n")
+
+    journal.close()
+    run_state.save()
+    print(f"Books: {delta_writer.summary()}")
@@ -1,8 +1,9 @@
 # This script automatically updates the description for library items using the AudiobookShelf API.
 
-import time
-import requests
-from urllib import parse
+from abs_client import AbsClient, MediaDeltaWriter, TokenBucket
+from lookup_cache import open_cache
+from run_metrics import write_metrics_at_exit
+from run_state import RunJournal, RunState, incremental_enabled, journal_options
 
 # Configuration constants
 ABS_HOST = ""  # AudiobookShelf Host URL
@@ -10,16 +11,54 @@ LIBRARY_ID = ""  # Library UUID
 API_KEY = ""  # API Key from user settings
 PROVIDER = "audible.com"  # Metadata provider (See available providers in API documentation https://api.audiobookshelf.org/#metadata-providers)
 DISABLE_RATE_PROTECTION = True  # Rate protection, disable to speed up but risk timeouts
+BATCH_SIZE = 100  # Number of descriptions updated per request. Older servers without the batch endpoint update them one by one.
+CACHE_FILE = "lookup_cache.sqlite"  # Provider lookups are cached in this file, so re-runs skip them. Set to None to disable the cache.
+CACHE_TTL_DAYS = 30  # Cached lookups older than this are fetched again
+INCREMENTAL = False  # Only process items that are new, changed or failed since the last run. Can also be enabled with --incremental.
+STATE_FILE = "update_descriptions.state.json"  # Outcome of the last run, used by the incremental mode
+RESUME = False  # Continue the last run where it stopped, e.g. after a crash. Can also be enabled with --resume.
+RETRY_FAILED = False  # Only process the books that failed in the last run. Can also be enabled with --retry-failed.
+JOURNAL_FILE = "update_descriptions.journal.jsonl"  # Outcome of every book of the current run, used to resume or retry
+METRICS_FILE = "update_descriptions.metrics"  # Requests, waits and timings of the run are written to <name>.json and <name>.prom (Prometheus textfile). Set to None to disable.
 
 
 ############################################################################################################
 
 book_info = {}
 
+write_metrics_at_exit(METRICS_FILE, "update_descriptions")
+client = AbsClient(ABS_HOST, API_KEY)
+delta_writer = MediaDeltaWriter(client.media_updater(BATCH_SIZE))
+lookup_cache = open_cache(CACHE_FILE, CACHE_TTL_DAYS)
+# Rate protection: at most one provider lookup every 2 seconds. Cached lookups are not limited.
+provider_bucket = TokenBucket(None if DISABLE_RATE_PROTECTION else 0.5, name="provider rate limit")
+pending_updates = []
+
+
+# Sends all collected description updates in batches. Descriptions that did not change are not sent.
+def flush_updates():
+	for item, status in delta_writer.write(pending_updates):
+		book_id = item['id']
+		title = book_info[book_id]['title']
+		if status is None:
+			print(f"    Description unchanged for '{title}'.")
+			book_info[book_id]['status'] = 'FINISHED'
+			book_info[book_id]['comment'] = 'Description unchanged'
+		elif status == 200:
+			print(f"    Description updated successfully for '{title}'.")
+			book_info[book_id]['status'] = 'FINISHED'
+			book_info[book_id]['comment'] = 'Description updated'
+		else:
+			print(f"    Error updating description for '{title}'. Response Code:", status)
+			book_info[book_id]['comment'] = 'Description update failed'
+		journal.record(book_id, book_info[book_id]['status'], book_info[book_id]['comment'])
+	pending_updates.clear()
+
+
 # Fetch all library items
-library_url = f"{ABS_HOST}/api/libraries/{LIBRARY_ID}/items?token={API_KEY}"
-print(f"Fetching library items from: {library_url}")
-response = requests.get(library_url)
+library_path = f"/api/libraries/{LIBRARY_ID}/items"
+print(f"Fetching library items from: {client.url(library_path)}")
+response = client.get(library_path)
 
 if response.status_code != 200:
 	print("Error fetching library items:", response.status_code)
@@ -28,8 +67,24 @@ if response.status_code != 200:
 items = response.json().get('results', [])
 print(f"Found {len(items)} items in the library.")
 
-# Process each item in the library
-for count, (item) in enumerate(items):
+run_state = RunState(STATE_FILE)
+if incremental_enabled(INCREMENTAL):
+	items = [item for item in items if run_state.needs_processing(item)]
+	print(f"Incremental mode: {len(items)} items are new, changed or failed in the last run.")
+
+run_items = items
+journal = RunJournal(JOURNAL_FILE, *journal_options(RESUME, RETRY_FAILED))
+if journal.resume or journal.retry_failed:
+	# Books that are not run again keep the outcome of the last run in the summary
+	for item in items:
+		entry = journal.entries.get(item['id'])
+		if entry is not None and not journal.should_process(item['id']):
+			book_info[item['id']] = { 'id': item['id'], 'title': item['media']['metadata'].get('title', "Unknown Title"), 'status': entry['status'], 'comment': entry['comment'] }
+	items = journal.select(items)
+	print(f"Continuing the last run: {len(items)} items left to process.")
+
+# Looks up the description of a single book. Returns the update for the book, or None if there is nothing to update.
+def process_book(item):
 	book_id = item['id']
 	metadata = item['media']['metadata']
 	title = metadata.get('title', "Unknown Title")
@@ -40,57 +95,64 @@ for count, (item) in enumerate(items):
 
 	if 'asin' not in metadata or metadata['asin'] is None:
 		book_info[book_id]['status'] = 'NO_ASIN'
-		match_url = f"{ABS_HOST}/api/search/books?title={parse.quote(title)}&author={parse.quote(authors)}&provider={PROVIDER}&token={API_KEY}"
+		match_params = {"title": title, "author": authors, "provider": PROVIDER}
 	else:
 		book_info[book_id]['status'] = 'ASIN_SEARCH'
-		match_url = f"{ABS_HOST}/api/search/books?title={metadata['asin']}&provider={PROVIDER}&token={API_KEY}"
+		match_params = {"title": metadata['asin'], "provider": PROVIDER}
 
-	new_item_response = requests.get(match_url)
+	search_status, search_results = lookup_cache.search(client, "books", PROVIDER, "", match_params, provider_bucket.acquire)
 
-	if new_item_response.status_code != 200:
-		print(f"    Error matching book '{title}':", new_item_response.json())
+	if search_status != 200:
+		print(f"    Error matching book '{title}':", search_results)
 		book_info[book_id]['comment'] = 'Error matching book'
-		continue
+		return None
 
-	if len(new_item_response.json()) == 0:
+	if len(search_results) == 0:
 		print(f"    Error matching book '{title}' (No results found).")
 		book_info[book_id]['comment'] = 'No results found'
-		continue
+		return None
 
-	best_match = new_item_response.json()[0]
+	best_match = search_results[0]
 	description = best_match.get('description', None)
 
 	if description is None:
 		print(f"    Error matching book '{title}' (No description found).")
 		book_info[book_id]['comment'] = 'Description retrieval failed - No description found'
-		continue
+		return None
 
 	print(f"    Description found")
 	new_metadata = {}
 	new_metadata['description'] = description
 
-	# Update description for the book
-	update_url = f"{ABS_HOST}/api/items/{book_id}/media?token={API_KEY}"
-	update_data = {"metadata": new_metadata}
-	update_response = requests.patch(update_url, json=update_data)
+	return {"metadata": new_metadata}
 
-	if update_response.status_code == 200:
-		print(f"    Description updated successfully for '{title}'.")
-		book_info[book_id]['status'] = 'FINISHED'
-		book_info[book_id]['comment'] = 'Description updated'
-	else:
-		print(f"    Error updating description for '{title}'. Response Code:", update_response.status_code)
-		book_info[book_id]['comment'] = 'Description update failed'
 
-	# Respect rate-limiting if enabled
-	if not DISABLE_RATE_PROTECTION:
-		time.sleep(2)
+# Process each item in the library
+for item in items:
+	update_data = process_book(item)
+	if update_data is None:
+		journal.record(item['id'], book_info[item['id']]['status'], book_info[item['id']]['comment'])
+		continue
+
+	# Queue the description update for the book, updates are sent in batches
+	pending_updates.append((item, update_data))
+	if len(pending_updates) >= BATCH_SIZE:
+		flush_updates()
+
+flush_updates()
+journal.close()
 
+for item in run_items:
+	if item['id'] in book_info:
+		run_state.record(item, book_info[item['id']]['status'], book_info[item['id']]['comment'])
+run_state.save()
 
 print("\n--- Summary ---")
 for book_id, info in book_info.items():
 	print(f"{info['title']} ({info['status']}): {info['comment']}")
 
+print(f"\nDescriptions: {delta_writer.summary()}")
+
 print("\n--- Failed Books ---")
 for book_id, info in book_info.items():
 	if info['status'] != 'FINISHED':